@@ -0,0 +1,171 @@
+"""
+asyncio mode of the web server: python-socketio AsyncServer on aiohttp, so mostly idle connections cost no threads.
+The games, the tick scheduler, the geometry workers and the sessions are the ones of server.py,
+only the transport is different. The event loop never runs the geometry:
+game operations go to an executor, ticks run in the scheduler threads and the events are sent back to the loop.
+Run it with `python async_server.py` instead of `python server.py`.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+import traceback
+
+from aiohttp import web
+import socketio
+
+import metrics
+import profiler
+import server
+import utils
+from utils import print_error_if_occured
+
+
+sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins="*")
+app = web.Application()
+sio.attach(app)
+
+# runs the game operations (and the session saving) off the event loop
+executor = ThreadPoolExecutor(max_workers=utils.default_config["tick_threads"], thread_name_prefix="game-operations")
+loop = None
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "index.html")) as f:
+    index_html = f.read()
+
+
+def emit_threadsafe(event_name, payload, **target):
+    """ Game events come from the executor, scheduler and worker threads, they are sent by the event loop """
+    asyncio.run_coroutine_threadsafe(sio.emit(event_name, payload, **target), loop)
+
+async def submit_game_operation(client_id, operation, data=None, target=None):
+    await loop.run_in_executor(executor, server.submit_game_operation, client_id, operation, data, target)
+
+async def has_game(client_id):
+    """ Same as server.has_game, the session file of a game that is not in memory is looked for in the executor, not on the event loop """
+    if server.has_game_in_memory(client_id):
+        return True
+    return await loop.run_in_executor(executor, server.has_game, client_id)
+
+
+async def index(request):
+    return web.Response(text=index_html, content_type='text/html')
+
+async def metrics_route(request):
+    """ Same as server.metrics_route, the metrics of the geometry workers lag behind by up to 5 s too """
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def admin_profile(request):
+    """ Same as server.admin_profile, the sampling runs in a thread of its own """
+    if not server.is_admin_token(request.headers.get("X-Admin-Token") or request.query.get("token")):
+        return web.Response(text="Forbidden", status=403)
+    seconds = server.parse_profile_seconds(request.query.get("seconds", 10))
+    if seconds is None:
+        return web.Response(text="seconds must be a positive number", status=400)
+    report = await loop.run_in_executor(None, profiler.profile, seconds, 0.001, request.query.get("game_id"))
+    if report is None:
+        return web.Response(text="Another profile is running", status=409)
+    return web.json_response(report, headers={"Content-Disposition": "attachment; filename=profile.speedscope.json"})
+
+async def tick_stats(request):
+    """ Per-game latency and fairness counters of the tick scheduler """
+    return web.json_response(server.tick_scheduler.get_stats())
+
+async def hover_quality(request):
+    """ Current level of the load-adaptive hover quality """
+    return web.json_response(server.tick_scheduler.get_governor_stats())
+
+async def shard(request):
+    """ Same as server.shard """
+    return web.json_response({"url": None})
+
+app.router.add_get('/', index)
+app.router.add_get('/shard/{game_id}', shard)
+app.router.add_get('/metrics', metrics_route)
+app.router.add_get('/admin/profile', admin_profile)
+app.router.add_get('/tick_stats', tick_stats)
+app.router.add_get('/hover_quality', hover_quality)
+
+
+@sio.on('connect')
+@print_error_if_occured
+async def handle_connect(sid, environ, auth=None):
+    print("Client connected")
+
+@sio.on('register')
+@print_error_if_occured
+async def handle_register(sid, client_id):
+    await sio.enter_room(sid, client_id)
+    # the full state is sent to the new member only, the room gets the same updates for all its members
+    await submit_game_operation(client_id, 'register', target={'to': sid})
+
+@sio.on('join_new_group')
+@print_error_if_occured
+async def join_new_group(sid, data):
+    client_id, new_group = data
+    await sio.leave_room(sid, client_id)
+    await submit_game_operation(client_id, 'view', {'sid': sid, 'detail_scale': None})
+    await handle_register(sid, new_group)
+
+@sio.on('game_action')
+@print_error_if_occured
+async def handle_game_action(sid, data):
+    client_id = data.get('client_id')
+
+    if not await has_game(client_id):
+        return
+
+    data['received_time'] = time.time()
+    # the scheduler only queues the input, it is applied by its threads
+    if data.get('action_type') == 'mouse_move':
+        if all(data.get(elem, None) is not None for elem in ["x", "y"]):
+            server.tick_scheduler.submit_mouse_move(client_id, data)
+        return
+
+    server.tick_scheduler.submit_action(client_id, data)
+
+@sio.on('view')
+@print_error_if_occured
+async def handle_view(sid, data):
+    """ Client reports the zoom it needs the geometry for when it changes, see Transformation.level_of_detail """
+    await submit_game_operation(data.get('client_id'), 'view', {'sid': sid, 'detail_scale': data['detail_scale']})
+
+@sio.on('request_keyframe')
+@print_error_if_occured
+async def handle_request_keyframe(sid, data):
+    """ Client missed a delta, so it gets the full current state """
+    await submit_game_operation(data.get('client_id'), 'keyframe', target={'to': sid})
+
+@sio.on('disconnect')
+@print_error_if_occured
+async def handle_disconnect(sid, *args):
+    print("Client disconnected")
+    for room in sio.rooms(sid):
+        # the zoom of the client is dropped only from the games in memory, a hibernated game is not loaded for it
+        if room != sid and server.has_game_in_memory(room):
+            await submit_game_operation(room, 'view', {'sid': sid, 'detail_scale': None})
+
+
+async def save_sessions_periodically():
+    """ Same as server.save_sessions_periodically, the saving itself runs in the executor """
+    while True:
+        await asyncio.sleep(5)
+        try:
+            await loop.run_in_executor(executor, server.save_sessions)
+        except Exception:
+            traceback.print_exc()
+
+async def start_background_tasks(app):
+    global loop
+    loop = asyncio.get_running_loop()
+    server.emit_event = emit_threadsafe
+    server.start_geometry_workers()
+    server.tick_scheduler.start(lambda target: threading.Thread(target=target, daemon=True).start())
+    app['save_sessions'] = asyncio.create_task(save_sessions_periodically())
+
+app.on_startup.append(start_background_tasks)
+
+
+if __name__ == '__main__':
+    os.makedirs("sessions", exist_ok=True)
+    web.run_app(app, host='0.0.0.0', port=int(os.environ.get("SUGO_PORT", 5000)))
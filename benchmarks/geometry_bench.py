@@ -0,0 +1,276 @@
+"""
+Micro-benchmarks of the core geometry on generated positions of 10 to 2000 stones on every board of utils.board_polygons.
+    python benchmarks/geometry_bench.py --output results.json --baseline benchmarks/geometry_baseline.json
+Results are JSON: median and min time of every (benchmark, board, number of stones).
+With --baseline the results are compared with the stored ones and the script exits with 1 on a regression.
+By default the scaling is compared (min time relative to the median of the min times of all the sizes of the same benchmark and board,
+both measured in the times of a calibration workload timed next to them), so a baseline stored on another machine
+still catches a worse complexity, --compare absolute compares the times themselves.
+Results faster than --min-time both now and in the baseline are not compared, their noise is larger than any regression.
+--save-baseline stores the results as the new baseline.
+"""
+import argparse
+from collections import defaultdict
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shapely
+
+from game_state import GameState, Stone, calculate_board_geometry
+from stones_structure import StoneStructure
+from utils import default_config, board_polygons, calculate_deltax_deltay, find_uncovered_arcs, split_stones_by_groups, calculate_connection_polygon
+
+
+DEFAULT_SIZES = [10, 50, 200, 500, 2000]
+# share of the board covered by the stones of a generated position
+STONES_DENSITY = 0.3
+# share of the stones that are put next to an earlier stone, so there are groups and connections like in real games
+TOUCHING_STONES_SHARE = 0.7
+# the calibration workload is timed this many times before every round of every benchmark, see run_benchmarks
+CALIBRATION_REPEATS = 3
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geometry_baseline.json")
+
+
+def make_config(board_name, n_stones):
+    """ Config of the board, the stones are smaller than the default ones if that many would not fit """
+    board_polygon = board_polygons[board_name]
+    area = shapely.Polygon(board_polygon).area
+    stone_radius = min(default_config["stone_radius"], math.sqrt(STONES_DENSITY * area / (n_stones * math.pi)))
+    return default_config | {"board_polygon": board_polygon, "stone_radius": stone_radius}
+
+
+def get_board_geometry(config):
+    """ (board, board_inner) the same as the ones of GameState """
+    delta_x, delta_y = calculate_deltax_deltay(config)
+    return calculate_board_geometry(tuple((delta_x + x, delta_y + y) for x, y in config["board_polygon"]), config["stone_radius"])
+
+
+def generate_position(config, n_stones, seed=0):
+    """
+    Random position of (up to) n_stones not overlapping stones of alternating colors inside the board,
+    most of them touch an earlier stone. Overlaps are checked on a grid of cells of the stone diameter
+    """
+    rng = random.Random(seed)
+    stone_radius = config["stone_radius"]
+    _, board_inner = get_board_geometry(config)
+    shapely.prepare(board_inner)
+    min_x, min_y, max_x, max_y = board_inner.bounds
+    cell_size = 2 * stone_radius
+    grid = dict()
+    stones = []
+
+    def fits(x, y):
+        if not shapely.contains_xy(board_inner, x, y):
+            return False
+        cell_x, cell_y = int(x // cell_size), int(y // cell_size)
+        for neighbour_x in range(cell_x - 1, cell_x + 2):
+            for neighbour_y in range(cell_y - 1, cell_y + 2):
+                for stone in grid.get((neighbour_x, neighbour_y), []):
+                    if (stone.x - x) ** 2 + (stone.y - y) ** 2 < (2 * stone_radius) ** 2 * (1 - 1e-9):
+                        return False
+        return True
+
+    for _ in range(200 * n_stones):
+        if len(stones) == n_stones:
+            break
+        if stones and rng.random() < TOUCHING_STONES_SHARE:
+            parent = rng.choice(stones)
+            angle = rng.uniform(-math.pi, math.pi)
+            x, y = parent.x + 2 * stone_radius * math.cos(angle), parent.y + 2 * stone_radius * math.sin(angle)
+        else:
+            x, y = rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)
+        if not fits(x, y):
+            continue
+        stone = Stone(x, y, ["black", "white"][len(stones) % 2])
+        stones.append(stone)
+        grid.setdefault((int(x // cell_size), int(y // cell_size)), []).append(stone)
+    return stones
+
+
+def make_benchmarks(config, stones, seed=0):
+    """ Returns {benchmark name: function without arguments} on the position """
+    stone_radius = config["stone_radius"]
+    board, board_inner = get_board_geometry(config)
+    structure = StoneStructure(stones, stone_radius, board)
+    # not the stream of generate_position, otherwise the pointers would hit the centers of the stones
+    rng = random.Random(f"snap_queries_{seed}")
+    min_x, min_y, max_x, max_y = board_inner.bounds
+    snap_queries = [(rng.uniform(min_x, max_x), rng.uniform(min_y, max_y), rng.choice([None, "black", "white"])) for _ in range(100)]
+    # the same arguments as StoneStructure._calculate_librety_intervals gives
+    neighbour_circles = [
+        [structure._ind_to_circle(index) for index in structure.calculate_all_vertexes_within_distance(i, 4 * stone_radius + 1e-5)][1:]
+        + structure._board_border_circles
+        for i in range(len(stones))
+    ]
+    edges = structure.calculate_connections_graph()
+    game_state = GameState(config, json={
+        "stones": [{"x": stone.x, "y": stone.y, "color": stone.color} for stone in stones],
+        "actions_counter": len(stones),
+        "passes_counter": 0,
+    })
+
+    def calculate_territory():
+        # the voronoi polygons are cached in the structure, so they are built again, otherwise only the areas would be summed
+        game_state.cached_stone_structures.get_structure("territory")._recalculate_delone_graph()
+        game_state._calculate_territory()
+
+    return {
+        "stone_structure": lambda: StoneStructure(stones, stone_radius, board),
+        "find_uncovered_arcs": lambda: [
+            find_uncovered_arcs(structure._ind_to_circle(i), neighbour_circles[i], structure._board_border_rectangles, alpha=1e-20, epsilon=0)
+            for i in range(len(stones))
+        ],
+        "calculate_snap_point_x100": lambda: [structure.calculate_snap_point(x, y, color) for x, y, color in snap_queries],
+        "delaunay_and_voronoi": structure._recalculate_delone_graph,
+        "calculate_territory": calculate_territory,
+        "split_stones_by_groups": lambda: split_stones_by_groups(stones, config),
+        "calculate_connection_polygon": lambda: [calculate_connection_polygon(stones[i].x, stones[i].y, stones[j].x, stones[j].y) for i, j in edges],
+    }
+
+
+def measure(function, time_budget, max_repeats):
+    """ Runs the function until time_budget is spent (at least once), returns the times of the runs """
+    times = []
+    start_time = time.perf_counter()
+    while len(times) < max_repeats and (not times or time.perf_counter() - start_time < time_budget):
+        run_start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - run_start_time)
+    return times
+
+
+def make_calibration(seed=0):
+    """ The calibration workload: StoneStructure of 50 stones on the square board, a few milliseconds of the usual geometry """
+    config = make_config("square", 50)
+    board, _ = get_board_geometry(config)
+    stones = generate_position(config, 50, seed)
+    return lambda: StoneStructure(stones, config["stone_radius"], board)
+
+
+def run_benchmarks(boards, sizes, time_budget, max_repeats, selected=None, seed=0, rounds=5):
+    """
+    The speed of a machine drifts (up to 2 times for seconds on shared ones), so the time budget and the repeats of every
+    benchmark are split into rounds over the whole run, and the calibration workload is timed right before every round.
+    relative_min is the median over the rounds of the min time of the round divided by its calibration time, it does not follow the drift
+    """
+    calibration = make_calibration(seed)
+    # (benchmark, board, number of stones) -> (function, placed stones)
+    benchmarks = dict()
+    for board_name in boards:
+        for n_stones in sizes:
+            config = make_config(board_name, n_stones)
+            stones = generate_position(config, n_stones, seed)
+            for name, function in make_benchmarks(config, stones, seed).items():
+                if not selected or name in selected:
+                    benchmarks[(name, board_name, n_stones)] = (function, len(stones))
+
+    times = {key: [] for key in benchmarks}
+    relative_times = {key: [] for key in benchmarks}
+    for round_index in range(rounds):
+        for (name, board_name, n_stones), (function, _) in benchmarks.items():
+            calibration_time = min(measure(calibration, math.inf, CALIBRATION_REPEATS))
+            round_times = measure(function, time_budget / rounds, max(max_repeats // rounds, 1))
+            times[(name, board_name, n_stones)].extend(round_times)
+            relative_times[(name, board_name, n_stones)].append(min(round_times) / calibration_time)
+            if round_index == rounds - 1:
+                print(f"{name:32} {board_name:8} {n_stones:5} {statistics.median(times[(name, board_name, n_stones)]) * 1000:10.3f} ms", file=sys.stderr)
+
+    results = [
+        {
+            "benchmark": name,
+            "board": board_name,
+            "n_stones": n_stones,
+            "placed_stones": placed_stones,
+            "median": statistics.median(times[(name, board_name, n_stones)]),
+            "min": min(times[(name, board_name, n_stones)]),
+            "relative_min": statistics.median(relative_times[(name, board_name, n_stones)]),
+            "repeats": len(times[(name, board_name, n_stones)]),
+        }
+        for (name, board_name, n_stones), (_, placed_stones) in benchmarks.items()
+    ]
+    add_scaling(results)
+    return results
+
+
+def add_scaling(results):
+    """
+    scaling is relative_min relative to the median of relative_min of all the sizes of the same benchmark and board,
+    min is the least noisy, and the median is steadier than the smallest position, which takes microseconds
+    """
+    min_times = defaultdict(list)
+    for result in results:
+        min_times[(result["benchmark"], result["board"])].append(result["relative_min"])
+    for result in results:
+        result["scaling"] = result["relative_min"] / statistics.median(min_times[(result["benchmark"], result["board"])])
+
+
+def find_regressions(results, baseline, compare, tolerance, min_time):
+    """ Results that are more than tolerance times slower (or worse scaling) than in the baseline, unless both take less than min_time """
+    baseline_results = {(result["benchmark"], result["board"], result["n_stones"]): result for result in baseline["results"]}
+    key = "median" if compare == "absolute" else "scaling"
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result["benchmark"], result["board"], result["n_stones"]))
+        if baseline_result is None or baseline_result[key] <= 0:
+            continue
+        if result["min"] < min_time and baseline_result["min"] < min_time:
+            continue
+        ratio = result[key] / baseline_result[key]
+        if ratio > tolerance:
+            regressions.append(result | {"baseline": baseline_result[key], "ratio": ratio})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--boards", nargs="+", default=list(board_polygons), choices=list(board_polygons))
+    parser.add_argument("--benchmarks", nargs="+", help="run only these benchmarks")
+    parser.add_argument("--time-budget", type=float, default=0.5, help="seconds per benchmark, it runs at least once")
+    parser.add_argument("--max-repeats", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5, help="the repeats of every benchmark are spread over this many rounds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the JSON results, stdout by default")
+    parser.add_argument("--baseline", help=f"compare with these results, e.g. {DEFAULT_BASELINE_PATH}")
+    parser.add_argument("--compare", choices=["scaling", "absolute"], default="scaling")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="slowdown ratio that is a regression")
+    parser.add_argument("--min-time", type=float, default=0.001, help="seconds, faster results are not compared")
+    parser.add_argument("--save-baseline", action="store_true", help=f"store the results in {DEFAULT_BASELINE_PATH}")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {"python": platform.python_version(), "machine": platform.machine(), "processor": platform.processor(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "seed": args.seed},
+        "results": run_benchmarks(args.boards, args.sizes, args.time_budget, args.max_repeats, args.benchmarks, args.seed, args.rounds),
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report["results"], json.load(f), args.compare, args.tolerance, args.min_time)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSION {regression['benchmark']} {regression['board']} {regression['n_stones']}: {args.compare} is {regression['ratio']:.2f} times the baseline", file=sys.stderr)
+        exit_code = 1 if regressions else 0
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE_PATH, "w") as f:
+            f.write(report_json)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
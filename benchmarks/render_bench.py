@@ -0,0 +1,128 @@
+"""
+Headless benchmark of rendering.render of the desktop client, on an offscreen surface with SDL's dummy video driver.
+    python benchmarks/render_bench.py games/*.sugo --output render.json
+Positions evenly spaced along the main line of the recorded games are rendered with every background and board style
+at several zoom levels of Transformation, the background moves every frame like in main.py.
+The report has frames per second and milliseconds per frame of every stage (see rendering.render) for every combination.
+Without paths a synthetic game of benchmarks/replay_bench.py is recorded first.
+"""
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pygame
+import shapely
+
+import rendering
+import utils
+from game_state import GameState
+from replay_bench import load_main_line, record_synthetic_game
+from transformation import Transformation
+
+
+STAGES = ["background", "shapes", "board_polygons", "info_panel"]
+
+
+def load_positions(paths, n_positions):
+    """ Returns [(config, game state json, name)] of n_positions evenly spaced positions of the main line of every game """
+    positions = []
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        recorded = load_main_line(data)
+        indexes = sorted({round(i * (len(recorded) - 1) / max(n_positions - 1, 1)) for i in range(n_positions)})
+        positions.extend((data["config"], recorded[index], f"{os.path.basename(path)} move {index}") for index in indexes)
+    return positions
+
+
+def make_transformation(config, log_scale):
+    """ The transformation of main.py zoomed to log_scale at the center of the board """
+    delta_x, delta_y = utils.calculate_deltax_deltay(config)
+    board = shapely.Polygon([[x + delta_x, y + delta_y] for x, y in config["board_polygon"]])
+    transformation = Transformation(0, 0, shapely.convex_hull(board))
+    if log_scale:
+        transformation.update_self_zoom(board.centroid.x, board.centroid.y, log_scale)
+    return transformation
+
+
+def benchmark_position(screen, config, game_state_json, zooms, n_frames):
+    """ Returns a result for every (background, board style, zoom) """
+    results = []
+    game_state = GameState(config, json=game_state_json)
+    for background_index, background in enumerate(game_state.background_to_render_list):
+        for board_index, board_style in enumerate(game_state.board_to_render_list):
+            game_state.background_to_render_index = background_index
+            game_state.board_to_render_index = board_index
+            for log_scale in zooms:
+                transformation = make_transformation(config, log_scale)
+                stage_times = dict()
+                start_time = time.perf_counter()
+                for _ in range(n_frames):
+                    game_state.update_background()
+                    rendering.render(screen, game_state, config, transformation, stage_times)
+                seconds = time.perf_counter() - start_time
+                results.append({
+                    "background": background,
+                    "board_style": board_style,
+                    "zoom": log_scale,
+                    "stones": len(game_state.placed_stones),
+                    "fps": n_frames / seconds,
+                    "frame_ms": seconds / n_frames * 1000,
+                } | {f"{stage}_ms": stage_times.get(stage, 0) / n_frames * 1000 for stage in STAGES})
+    return results
+
+
+def print_report(results):
+    combinations = sorted({(result["background"], result["board_style"], result["zoom"]) for result in results})
+    print(f"{'background':10} {'board':6} {'zoom':>5} {'fps':>7} {'frame':>8} " + " ".join(f"{stage:>14}" for stage in STAGES) + "  (ms)")
+    for background, board_style, zoom in combinations:
+        selected = [result for result in results if (result["background"], result["board_style"], result["zoom"]) == (background, board_style, zoom)]
+        mean = lambda key: sum(result[key] for result in selected) / len(selected)
+        print(f"{background:10} {board_style:6} {zoom:5.2f} {1000 / mean('frame_ms'):7.1f} {mean('frame_ms'):8.2f} " + " ".join(f"{mean(stage + '_ms'):14.2f}" for stage in STAGES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help=".sugo files")
+    parser.add_argument("--positions", type=int, default=4, help="positions of every game")
+    parser.add_argument("--zooms", type=float, nargs="+", default=[0, 0.75, 1.5], help="log scales of Transformation")
+    parser.add_argument("--frames", type=int, default=20, help="frames of every combination")
+    parser.add_argument("--synthetic-moves", type=int, default=150, help="moves of the synthetic game recorded when no paths are given")
+    parser.add_argument("--output", help="path of the JSON report")
+    args = parser.parse_args()
+
+    paths = args.paths
+    if not paths:
+        paths = [os.path.join(tempfile.mkdtemp(prefix="sugo-render-"), "synthetic_0.sugo")]
+        print(f"recording a synthetic game to {paths[0]}", file=sys.stderr)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            record_synthetic_game(paths[0], args.synthetic_moves)
+
+    pygame.init()
+    results = []
+    for config, game_state_json, name in load_positions(paths, args.positions):
+        print(f"rendering {name}", file=sys.stderr)
+        utils.update_colors(config=config)
+        screen = pygame.Surface((config["width"], config["height"]))
+        results.extend(result | {"position": name} for result in benchmark_position(screen, config, game_state_json, args.zooms, args.frames))
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {"python": platform.python_version(), "machine": platform.machine(), "pygame": pygame.version.ver, "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
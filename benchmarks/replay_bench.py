@@ -0,0 +1,309 @@
+"""
+End-to-end benchmark that replays saved .sugo games through GameStateHistory.update, headless.
+    python benchmarks/replay_bench.py games/*.sugo --output replay.json
+Every recorded transition of the main line is turned back into the actions of a player: a few hover MOUSE_MOTION actions
+moving the pointer to the next stone and the click, a pass, or the dead marking. After some moves an undo with a redo
+and a dead marking with its undo are interleaved. The report has the latency distribution of every action type
+and the slowest positions. A replayed position that differs from the recorded one is counted and reloaded from the file,
+the script exits with 1 if any transition diverged or the geometry failed, the latencies of such a replay are not the recorded game's.
+Without paths a few synthetic games are recorded first (random moves next to earlier stones, so with groups and captures),
+real games are the ones to trust.
+"""
+import argparse
+from contextlib import redirect_stdout
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pygame
+from shapely.errors import GEOSException
+
+from game_history import GameStateHistory
+from game_state import GameState, Stone
+from game_tree import GameTree
+from handle_input import ActionType
+from utils import default_config, calculate_position_hash
+
+
+# hover actions before every click, the pointer comes to the stone like a hand would
+HOVER_STEPS = 5
+
+
+def load_main_line(data):
+    """ States from the root to the current node of a saved game, files saved before the tree have only the main line """
+    if "tree" in data:
+        tree, current_node = GameTree.from_json(data["tree"])
+        return [tree.get_json(node) for node in tree.path_to_root(current_node)]
+    return data["history"]
+
+
+def _stone_key(stone_dict):
+    return round(stone_dict["x"], 6), round(stone_dict["y"], 6), stone_dict["color"]
+
+
+def _stone_keys(game_state_json):
+    return sorted(_stone_key(stone_dict) for stone_dict in game_state_json["stones"])
+
+
+def _position_hash(game_state_json, quantum):
+    if "position_hash" in game_state_json:
+        return game_state_json["position_hash"]
+    return calculate_position_hash([Stone(**stone_dict) for stone_dict in game_state_json["stones"]], quantum)
+
+
+def _marked_stones(game_state_json):
+    return {_stone_key(stone_dict) for stone_dict in game_state_json["stones"] if stone_dict.get("secondary_color", stone_dict["color"]) != stone_dict["color"]}
+
+
+def infer_transition(previous, following):
+    """
+    What the player did between two recorded states: ("place_stone", stone dict), ("pass", None),
+    ("mark_dead", stone dict of the marked or unmarked group) or ("unknown", None)
+    """
+    previous_stones = {_stone_key(stone_dict) for stone_dict in previous["stones"]}
+    added_stones = [stone_dict for stone_dict in following["stones"] if _stone_key(stone_dict) not in previous_stones]
+    if len(added_stones) == 1:
+        return "place_stone", added_stones[0]
+    if added_stones:
+        return "unknown", None
+    if following["passes_counter"] > previous["passes_counter"]:
+        return "pass", None
+    changed_marks = _marked_stones(previous) ^ _marked_stones(following)
+    if changed_marks and len(following["stones"]) == len(previous["stones"]):
+        x, y, color = next(iter(changed_marks))
+        return "mark_dead", {"x": x, "y": y, "color": color}
+    return "unknown", None
+
+
+class Replayer:
+    def __init__(self, undo_rate, mark_dead_rate, seed=0):
+        self.undo_rate = undo_rate
+        self.mark_dead_rate = mark_dead_rate
+        self.random = random.Random(seed)
+        self.samples = []  # {"action_type", "seconds", "file", "move", "stones"}
+        self.divergences = 0
+        self.unknown_transitions = 0
+        self.geometry_errors = 0
+
+    def _timed_update(self, history, action_type, action, file_name, move):
+        stones = len(history.current_game_state.placed_stones)
+        start_time = time.perf_counter()
+        if not update_or_restore(history, action):
+            self.geometry_errors += 1
+            return
+        self.samples.append({"action_type": action_type, "seconds": time.perf_counter() - start_time, "file": file_name, "move": move, "stones": stones})
+
+    def _press_key(self, history, key, action_type, file_name, move):
+        self._timed_update(history, action_type, {"action_type": ActionType.KEY_DOWN, "key": key}, file_name, move)
+
+    def _set_marking_dead_mode(self, history, is_on, file_name, move):
+        game_state = history.current_game_state
+        if game_state.marking_dead_mode[game_state.player_to_move] != is_on:
+            self._press_key(history, pygame.K_x, "key", file_name, move)
+
+    def _hover_to(self, history, pointer, target, file_name, move):
+        stone_radius = history.current_game_state.stone_radius
+        for step in range(1, HOVER_STEPS + 1):
+            share = step / HOVER_STEPS
+            jitter = stone_radius * (1 - share)
+            x = pointer[0] + (target[0] - pointer[0]) * share + self.random.gauss(0, jitter)
+            y = pointer[1] + (target[1] - pointer[1]) * share + self.random.gauss(0, jitter)
+            if step == HOVER_STEPS:
+                # the sum above is a few ulps off the target, the click comes exactly on it
+                x, y = target
+            self._timed_update(history, "hover", {"action_type": ActionType.MOUSE_MOTION, "x": x, "y": y}, file_name, move)
+        return target
+
+    def _click(self, history, action_type, x, y, file_name, move):
+        self._timed_update(history, action_type, {"action_type": ActionType.MOUSE_DOWN_LEFT, "x": x, "y": y}, file_name, move)
+
+    def _interleave_synthetic_actions(self, history, file_name, move):
+        """ Undo with redo and a dead marking with its undo, so the position stays the recorded one """
+        if self.random.random() < self.undo_rate and history.current_node.parent is not None:
+            self._timed_update(history, "undo", {"action_type": ActionType.UNDO}, file_name, move)
+            self._timed_update(history, "redo", {"action_type": ActionType.REDO}, file_name, move)
+
+        game_state = history.current_game_state
+        own_stones = [stone for stone in game_state.placed_stones if stone.color == game_state.colors[game_state.player_to_move]]
+        if self.random.random() < self.mark_dead_rate and own_stones:
+            stone = self.random.choice(own_stones)
+            actions_counter = game_state.actions_counter
+            self._set_marking_dead_mode(history, True, file_name, move)
+            self._click(history, "mark_dead", stone.x, stone.y, file_name, move)
+            if history.current_game_state.actions_counter != actions_counter:
+                self._timed_update(history, "undo", {"action_type": ActionType.UNDO}, file_name, move)
+            else:
+                self._set_marking_dead_mode(history, False, file_name, move)
+
+    def replay_file(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        config, recorded = data["config"], load_main_line(data)
+        quantum = config.get("position_hash_quantum", default_config["position_hash_quantum"])
+        file_name = os.path.basename(path)
+
+        history = GameStateHistory(config)
+        history.load_from_json_string(json.dumps({"config": config, "history": recorded[:1]}))
+        min_x, min_y, max_x, max_y = history.current_game_state.board_inner.bounds
+        pointer = ((min_x + max_x) / 2, (min_y + max_y) / 2)
+
+        for move, (previous, following) in enumerate(zip(recorded, recorded[1:]), start=1):
+            kind, stone_dict = infer_transition(previous, following)
+            if kind == "place_stone":
+                self._set_marking_dead_mode(history, False, file_name, move)
+                pointer = self._hover_to(history, pointer, (stone_dict["x"], stone_dict["y"]), file_name, move)
+                self._click(history, "place_stone", stone_dict["x"], stone_dict["y"], file_name, move)
+            elif kind == "pass":
+                self._set_marking_dead_mode(history, False, file_name, move)
+                self._press_key(history, pygame.K_p, "pass", file_name, move)
+            elif kind == "mark_dead":
+                self._set_marking_dead_mode(history, True, file_name, move)
+                self._click(history, "mark_dead", stone_dict["x"], stone_dict["y"], file_name, move)
+            else:
+                self.unknown_transitions += 1
+
+            game_state = history.current_game_state
+            if game_state.position_hash != _position_hash(following, quantum) or _marked_stones(game_state.to_json()) != _marked_stones(following):
+                if kind != "unknown":
+                    self.divergences += 1
+                history.load_from_json_string(json.dumps({"config": config, "history": recorded[:move + 1]}))
+            elif kind == "place_stone":
+                self._interleave_synthetic_actions(history, file_name, move)
+
+
+def update_or_restore(history, action):
+    """ history.update, if the geometry fails (GEOS does on some near touching stones) the position of the current node is restored """
+    try:
+        history.update(action)
+        return True
+    except GEOSException:
+        history.current_game_state = GameState(history.config, json=history.tree.get_json(history.current_node))
+        return False
+
+
+def record_synthetic_game(path, n_moves, seed=0):
+    """
+    Plays random moves next to earlier stones, hovering before every click like a player, with rare passes, and saves the game.
+    Only the moves that Replayer places again the same way are kept, so the game replays without divergences
+    """
+    rng = random.Random(seed)
+    history = GameStateHistory(default_config)
+    min_x, min_y, max_x, max_y = history.current_game_state.board_inner.bounds
+    for _ in range(n_moves):
+        game_state = history.current_game_state
+        # never two passes in a row, they end the game
+        if rng.random() < 0.02 and game_state.passes_counter == 0:
+            update_or_restore(history, {"action_type": ActionType.KEY_DOWN, "key": pygame.K_p})
+            continue
+        if game_state.placed_stones and rng.random() < 0.8:
+            parent = rng.choice(game_state.placed_stones)
+            angle = rng.uniform(-math.pi, math.pi)
+            distance = 2 * game_state.stone_radius * rng.uniform(1, 1.3)
+            x, y = parent.x + distance * math.cos(angle), parent.y + distance * math.sin(angle)
+        else:
+            x, y = rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)
+        update_or_restore(history, {"action_type": ActionType.MOUSE_MOTION, "x": x, "y": y})
+        game_state = history.current_game_state
+        if game_state.dont_show_suggestion_stone:
+            continue
+        previous_node = history.current_node
+        update_or_restore(history, {"action_type": ActionType.MOUSE_DOWN_LEFT, "x": game_state.suggestion_stone.x, "y": game_state.suggestion_stone.y})
+        if history.current_node is not previous_node and not _replays_cleanly(history, previous_node):
+            history.switch_to_node(previous_node.node_id)
+    history.save_to_file(path)
+
+
+def _replays_cleanly(history, previous_node):
+    """
+    The move to the current node is made again like Replayer makes it: the pointer comes to the placed stone and clicks it,
+    and the stones are compared to 6 digits. A stone touching others can snap a bit away or fail in GEOS
+    when clicked exactly, such moves are not recorded. The game goes on from the node of the second click
+    """
+    node = history.current_node
+    kind, stone_dict = infer_transition(history.tree.get_json(previous_node), history.tree.get_json(node))
+    if kind != "place_stone":
+        return False
+    history.switch_to_node(previous_node.node_id)
+    update_or_restore(history, {"action_type": ActionType.MOUSE_MOTION, "x": stone_dict["x"], "y": stone_dict["y"]})
+    update_or_restore(history, {"action_type": ActionType.MOUSE_DOWN_LEFT, "x": stone_dict["x"], "y": stone_dict["y"]})
+    if history.current_node is previous_node:
+        return False
+    return _stone_keys(history.tree.get_json(history.current_node)) == _stone_keys(history.tree.get_json(node))
+
+
+def summarize(samples, n_slowest):
+    summary = dict()
+    for action_type in sorted({sample["action_type"] for sample in samples}):
+        milliseconds = np.array([sample["seconds"] for sample in samples if sample["action_type"] == action_type]) * 1000
+        p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+        summary[action_type] = {"count": len(milliseconds), "mean_ms": milliseconds.mean(), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "max_ms": milliseconds.max()}
+    slowest = [
+        {key: value for key, value in sample.items() if key != "seconds"} | {"ms": sample["seconds"] * 1000}
+        for sample in sorted(samples, key=lambda sample: -sample["seconds"])[:n_slowest]
+    ]
+    return summary, slowest
+
+
+def print_report(summary, slowest, replayer):
+    print(f"{'action type':12} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for action_type, stats in summary.items():
+        print(f"{action_type:12} {stats['count']:7} " + " ".join(f"{stats[key]:9.2f}" for key in ["mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]))
+    print(f"diverged transitions: {replayer.divergences}, unknown transitions: {replayer.unknown_transitions}, geometry errors: {replayer.geometry_errors}")
+    print("slowest positions:")
+    for sample in slowest:
+        print(f"  {sample['ms']:9.2f} ms  {sample['action_type']:12} {sample['file']} move {sample['move']}, {sample['stones']} stones")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help=".sugo files")
+    parser.add_argument("--synthetic-games", type=int, default=3, help="games recorded when no paths are given")
+    parser.add_argument("--synthetic-moves", type=int, default=150)
+    parser.add_argument("--undo-rate", type=float, default=0.1, help="share of the moves followed by an undo and a redo")
+    parser.add_argument("--mark-dead-rate", type=float, default=0.05, help="share of the moves followed by a dead marking and its undo")
+    parser.add_argument("--slowest", type=int, default=10, help="number of the slowest positions in the report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the JSON report")
+    args = parser.parse_args()
+
+    paths = args.paths
+    if not paths:
+        directory = tempfile.mkdtemp(prefix="sugo-replay-")
+        paths = [os.path.join(directory, f"synthetic_{seed}.sugo") for seed in range(args.seed, args.seed + args.synthetic_games)]
+        print(f"recording {args.synthetic_games} synthetic games to {directory}", file=sys.stderr)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            for seed, path in enumerate(paths, start=args.seed):
+                record_synthetic_game(path, args.synthetic_moves, seed)
+
+    replayer = Replayer(args.undo_rate, args.mark_dead_rate, args.seed)
+    for path in paths:
+        print(f"replaying {path}", file=sys.stderr)
+        # GameStateHistory prints about the impossible moves
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            replayer.replay_file(path)
+
+    summary, slowest = summarize(replayer.samples, args.slowest)
+    print_report(summary, slowest, replayer)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {"python": platform.python_version(), "machine": platform.machine(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "files": paths},
+                "summary": summary,
+                "slowest": slowest,
+                "divergences": replayer.divergences,
+                "unknown_transitions": replayer.unknown_transitions,
+                "geometry_errors": replayer.geometry_errors,
+            }, f, indent=2)
+    sys.exit(1 if replayer.divergences or replayer.geometry_errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Checks web_protocol.snap_point (the snapping of the web client) against GameState._snap_stone on generated positions.
+    python benchmarks/snap_point_check.py --sizes 10 50 200 --queries 200
+For every board of utils.board_polygons, number of stones and placement mode, the snapping data goes through
+pack_snapping and unpack_snapping like it does to the client, and random pointers over the board are snapped both ways.
+Prints the mismatches and exits with 1 if there are any.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shapely
+
+from game_state import ActionType, GameState, PlacementsModes
+from geometry_bench import generate_position, make_config
+from utils import board_polygons, project_point_onto_polygon
+from web_protocol import pack_snapping, snap_point, unpack_snapping
+
+
+def snap_with_game_state(game_state, x, y):
+    """ The suggestion stone of GameState for the pointer, or None if it is hidden """
+    x, y = project_point_onto_polygon(game_state.board_inner, shapely.Point(x, y)).coords[0]
+    game_state.previous_move_action = {"action_type": ActionType.MOUSE_MOTION, "x": x, "y": y}
+    game_state.update_suggestion_stone_status()
+    x, y = game_state._snap_stone(x, y)
+    return None if x is None or y is None else (x, y)
+
+
+def check_position(config, stones, n_queries, seed):
+    """ Returns [(placement mode, pointer, GameState point, snap_point point)] of the pointers snapped differently """
+    game_state = GameState(config, json={
+        "stones": [{"x": stone.x, "y": stone.y, "color": stone.color} for stone in stones],
+        "actions_counter": len(stones),
+        "passes_counter": 0,
+    })
+    rng = random.Random(f"snap_point_check_{seed}")
+    min_x, min_y, max_x, max_y = game_state.board.bounds
+    mismatches = []
+    for mode_index, mode in enumerate(PlacementsModes):
+        game_state.placement_modes[game_state.player_to_move] = mode_index
+        snapping = unpack_snapping(pack_snapping(game_state.get_snapping_data()))
+        for _ in range(n_queries):
+            x, y = rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)
+            expected = snap_with_game_state(game_state, x, y)
+            point = snap_point(snapping, x, y)
+            if (expected is None) != (point is None) or (point is not None and math.dist(point, expected) > 1e-6):
+                mismatches.append((mode.name, (x, y), expected, point))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--boards", nargs="+", default=list(board_polygons), choices=list(board_polygons))
+    parser.add_argument("--queries", type=int, default=100, help="pointers of every position and placement mode")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    n_mismatches = 0
+    for board_name in args.boards:
+        for n_stones in args.sizes:
+            config = make_config(board_name, n_stones)
+            mismatches = check_position(config, generate_position(config, n_stones, args.seed), args.queries, args.seed)
+            n_mismatches += len(mismatches)
+            print(f"{board_name:8} {n_stones:5} {len(mismatches)} mismatches of {args.queries * len(PlacementsModes)}", file=sys.stderr)
+            for mode, pointer, expected, point in mismatches:
+                print(f"MISMATCH {board_name} {n_stones} {mode} pointer {pointer}: GameState {expected}, snap_point {point}", file=sys.stderr)
+    sys.exit(1 if n_mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Rolling per-stage frame timings of the desktop client, drawn by rendering.draw_frame_timings (toggled on F3).
+The stages of the main loop and of rendering.render are timed with rendering.add_stage_time.
+Snapping, territory and StoneStructure builds happen inside game_history.update, they are already timed
+by the metrics of GameState and MyCache, so their per frame time is the difference of the metrics totals.
+"""
+from collections import deque
+import time
+
+import metrics
+
+
+# (stage, histogram), these stages are mostly parts of the "update" stage, get_draw_list in rendering may update the state too
+NESTED_STAGES = [
+    ("snapping", metrics.snap_time),
+    ("territory", metrics.territory_time),
+    ("structure builds", metrics.stone_structure_build_time),
+]
+# (stage, depth in the overlay) in the order of the frame
+STAGES = [
+    ("frame", 0),
+    ("input", 1),
+    ("update", 1),
+    *[(stage, 2) for stage, _ in NESTED_STAGES],
+    ("background", 1),
+    ("shapes", 1),
+    ("board_polygons", 1),
+    ("info_panel", 1),
+    ("frame_timings", 1),
+    ("ui", 1),
+]
+
+
+class FrameTimings:
+    def __init__(self, n_frames=60):
+        self._frames = deque(maxlen=n_frames)  # {stage: seconds} | {"rebuilds", "cache_hits", "cache_misses", "stones", "end_time"}
+        self._last_totals = self._get_metrics_totals()
+
+    @staticmethod
+    def _get_metrics_totals():
+        return {
+            "histograms": {stage: histogram.get_count_and_sum() for stage, histogram in NESTED_STAGES},
+            "cache_hits": metrics.structure_cache_hits.get(),
+            "cache_misses": metrics.structure_cache_misses.get(),
+        }
+
+    def end_frame(self, stage_times, n_stones):
+        """ stage_times are the seconds of the stages of the frame that has just ended """
+        totals, last_totals = self._get_metrics_totals(), self._last_totals
+        frame = dict(stage_times)
+        for stage, _ in NESTED_STAGES:
+            frame[stage] = totals["histograms"][stage][1] - last_totals["histograms"][stage][1]
+        frame["rebuilds"] = totals["histograms"]["structure builds"][0] - last_totals["histograms"]["structure builds"][0]
+        frame["cache_hits"] = totals["cache_hits"] - last_totals["cache_hits"]
+        frame["cache_misses"] = totals["cache_misses"] - last_totals["cache_misses"]
+        frame["stones"] = n_stones
+        frame["end_time"] = time.perf_counter()
+        self._frames.append(frame)
+        self._last_totals = totals
+
+    def get_info(self):
+        """ Lines of the overlay: mean and max of every stage over the last frames, the structure cache and the stones """
+        if not self._frames:
+            return dict()
+        frames = self._frames
+        info = dict()
+        if len(frames) > 1:
+            info["FPS"] = f"{(len(frames) - 1) / (frames[-1]['end_time'] - frames[0]['end_time']):.1f}"
+        for stage, depth in STAGES:
+            times = [frame.get(stage, 0) * 1000 for frame in frames]
+            info["  " * depth + stage] = f"{sum(times) / len(times):6.2f} ms (max {max(times):6.2f})"
+        mean = lambda key: sum(frame[key] for frame in frames) / len(frames)
+        info["Structure rebuilds per frame"] = f"{mean('rebuilds'):.2f}"
+        info["Cache hits / misses per frame"] = f"{mean('cache_hits'):.2f} / {mean('cache_misses'):.2f}"
+        info["Stones"] = frames[-1]["stones"]
+        return info
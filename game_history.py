@@ -1,62 +1,133 @@
 import json
+from collections import Counter
 
 
-from game_state import GameState
+from game_state import GameState, Stone
+from game_tree import GameTree
 from handle_input import ActionType
-from utils import get_readable_filepath
+from utils import get_readable_filepath, calculate_position_hash, default_config
 
 
 class GameStateHistory:
     def __init__(self, config):
         self.config = config
         self.current_game_state = GameState(config=config)
-        self.history = [self.current_game_state.to_json()]
-    
+        self.tree = GameTree(self.current_game_state.to_json())
+        self.current_node = self.tree.root
+        self._history = None  # cached states from the root to the current node, see history
+        self.position_hashes = Counter()  # multiset of position hashes from the root to the current node, used for superko check
+        self._recalculate_position_hashes()
+
+    @property
+    def history(self):
+        """ States from the beginning of the game to the current node, cached until the current node changes, must not be changed """
+        if self._history is None:
+            self._history = [self.tree.get_json(node) for node in self.tree.path_to_root(self.current_node)]
+        return self._history
+
+    def _recalculate_position_hashes(self):
+        self.position_hashes = Counter(node.info["position_hash"] for node in self.tree.path_to_root(self.current_node))
+
+    def _repeats_earlier_position(self):
+        position_hash = self.current_game_state.position_hash
+        return position_hash != self.current_node.info["position_hash"] and position_hash in self.position_hashes
+
+    def _switch_to_node(self, node):
+        old_node, new_node = self.current_node, node
+        while old_node is not new_node:
+            if old_node.depth >= new_node.depth:
+                position_hash = old_node.info["position_hash"]
+                self.position_hashes[position_hash] -= 1
+                if self.position_hashes[position_hash] <= 0:
+                    del self.position_hashes[position_hash]
+                old_node = old_node.parent
+            else:
+                self.position_hashes[new_node.info["position_hash"]] += 1
+                new_node = new_node.parent
+
+        if node.parent is not None:
+            node.parent.last_visited_child = node
+        self.current_node = node
+        self._history = None
+        self.current_game_state = GameState(self.config, json=self.tree.get_json(node))
+
+    def switch_to_node(self, node_id):
+        self._switch_to_node(self.tree.nodes[node_id])
+
     def update(self, action):
         if action is None:
             self.current_game_state.update(None)
-            return 
-        
+            return
+
         if action["action_type"] == ActionType.UNDO:
-            if len(self.history) >= 2:
-                self.history.pop()
-                self.current_game_state = GameState(self.config, json=self.history[-1])
+            if self.current_node.parent is not None:
+                self._switch_to_node(self.current_node.parent)
             else:
                 print("Trying to undo empty position")
             return
-        
+
+        if action["action_type"] == ActionType.REDO:
+            child = self.current_node.last_visited_child or (self.current_node.children[-1] if self.current_node.children else None)
+            if child is not None:
+                self._switch_to_node(child)
+            else:
+                print("Nothing to redo")
+            return
+
         actions_counter = self.current_game_state.actions_counter
         self.current_game_state.update(action)
         if not self.current_game_state.is_position_possible:
-            self.current_game_state = GameState(self.config, self.history[-1])
+            self.current_game_state = GameState(self.config, self.tree.get_json(self.current_node))
             print("Impossible move! The move has been undone")
         elif self.current_game_state.actions_counter != actions_counter:
-            self.history.append(self.current_game_state.to_json())
-    
+            if self._repeats_earlier_position():
+                self.current_game_state = GameState(self.config, self.tree.get_json(self.current_node))
+                print("Impossible move! It repeats an earlier position, the move has been undone")
+                return
+            child = self.tree.add_child(self.current_node, self.current_game_state.to_json())
+            self.current_node.last_visited_child = child
+            self.current_node = child
+            if self._history is not None:
+                # a new list, the returned ones stay the states of their node
+                self._history = self._history + [self.tree.get_json(child)]
+            self.position_hashes[child.info["position_hash"]] += 1
+
+    def _to_json(self):
+        return {
+            "config": self.config,
+            "tree": self.tree.to_json(self.current_node),
+        }
+
+    def _load_json(self, data):
+        self.config = data["config"]
+        if "tree" in data:
+            self.tree, self.current_node = GameTree.from_json(data["tree"])
+        else:
+            quantum = self.config.get("position_hash_quantum", default_config["position_hash_quantum"])
+            for game_state_json in data["history"]:
+                if "position_hash" not in game_state_json:
+                    game_state_json["position_hash"] = calculate_position_hash([Stone(**stone_dict) for stone_dict in game_state_json["stones"]], quantum)
+            self.tree, self.current_node = GameTree.from_history(data["history"])
+        self._history = None
+        self._recalculate_position_hashes()
+        self.current_game_state = GameState(self.config, json=self.tree.get_json(self.current_node))
+
     def save_to_file(self, filepath=None):
         if filepath is None:
             filepath = get_readable_filepath()
-        
+
         with open(filepath, "w") as f:
-            json.dump({"config": self.config, "history": self.history}, f)
-    
+            json.dump(self._to_json(), f)
+
     def open_from_a_file(self, filepath):
         self.save_to_file()
 
         with open(filepath, "r") as f:
             json_info = json.load(f)
-        self.history = json_info["history"]
-        self.config = json_info["config"]
-        self.current_game_state = GameState(self.config, json=self.history[-1])
-    
+        self._load_json(json_info)
+
     def to_json_string(self):
-        return json.dumps({
-            "config": self.config,
-            "history": self.history
-        })
+        return json.dumps(self._to_json())
 
     def load_from_json_string(self, json_string):
-        data = json.loads(json_string)
-        self.config = data["config"]
-        self.history = data["history"]
-        self.current_game_state = GameState(self.config, json=self.history[-1])
+        self._load_json(json.loads(json_string))
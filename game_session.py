@@ -0,0 +1,444 @@
+"""
+Logic of a single web game that does not depend on the transport.
+server.py runs it in its own process under the game lock, geometry_workers.py runs it in the worker processes.
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import shapely
+from pygame.locals import *
+
+import metrics
+import utils
+from game_history import GameStateHistory
+from game_state import Circle, PolygonShape, GLYPH_KINDS, HoverQuality, get_glyph_polygon
+from game_tree import GameTree
+from handle_input import ActionType
+from transformation import Transformation
+from utils import print_error_if_occured
+from web_protocol import StateDiffer, pack_snapping, packed_size
+
+
+def create_game_data(config=None):
+    config = config or utils.default_config
+    utils.update_colors(config)
+    return {
+        'history': GameStateHistory(config),
+        # the view is owned by the web clients, this transformation only gives the level of detail
+        'transformation': Transformation(0, 0, shapely.Polygon(config["board_polygon"])),
+        'config': config,
+        'lock': threading.RLock(),
+        'state_differ': StateDiffer(config["keyframe_interval"]),
+        'last_activity': time.monotonic(),
+    }
+
+def load_or_create_game_data(client_id, operation):
+    """
+    Game that is not in memory is loaded from its saved session, a new one is created only on 'register'. Returns None otherwise.
+    'view' never loads a game: the zooms of the clients are not saved, so there is nothing to change in a hibernated game
+    """
+    if operation == 'view':
+        return None
+    game_data = load_game_session(client_id)
+    if game_data is None and operation == 'register':
+        game_data = create_game_data()
+    return game_data
+
+def collect_session_changes(game_data, compaction_entries):
+    """
+    Sessions are saved as a snapshot sessions/<client_id>.json plus an append-only journal sessions/<client_id>.journal,
+    every journal line has the tree nodes added since the previous save and the current node.
+    The transformation is not saved: the view is owned by the web clients and the server never changes it.
+    Returns (kind, changes) to write with write_session_changes, kind is 'snapshot' or 'journal',
+    or None if nothing has changed since the previous save. After compaction_entries journal lines a snapshot is taken.
+    Journal lines of older generations are left from a crash during compaction and are skipped on load.
+    Must be called under game_data['lock']. Only references are taken here: tree nodes are never changed after they are added,
+    so the changes are encoded to JSON by write_session_changes outside of the lock.
+    """
+    tree = game_data['history'].tree
+    current_node_id = game_data['history'].current_node.node_id
+    saved = game_data.get('saved')
+    if saved is None or game_data.get('needs_snapshot') or saved['journal_entries'] >= compaction_entries:
+        game_data['journal_generation'] = game_data.get('journal_generation', -1) + 1
+        game_data['needs_snapshot'] = False
+        game_data['saved'] = {'nodes': len(tree.nodes), 'current': current_node_id, 'journal_entries': 0}
+        return 'snapshot', {
+            "nodes": list(tree.nodes),
+            "current": current_node_id,
+            "config": game_data['config'],
+            "journal_generation": game_data['journal_generation'],
+        }
+    
+    if saved['nodes'] == len(tree.nodes) and saved['current'] == current_node_id:
+        return None
+    
+    entry = {
+        "generation": game_data['journal_generation'],
+        "first_node": saved['nodes'],
+        "nodes": tree.nodes[saved['nodes']:],
+        "current": current_node_id,
+    }
+    game_data['saved'] = {'nodes': len(tree.nodes), 'current': current_node_id, 'journal_entries': saved['journal_entries'] + 1}
+    return 'journal', entry
+
+def encode_session_changes(kind, changes):
+    """ JSON of the snapshot file or of the journal line from collect_session_changes """
+    nodes_json = [GameTree.node_to_json(node) for node in changes["nodes"]]
+    if kind == 'journal':
+        return json.dumps(changes | {"nodes": nodes_json})
+    return json.dumps({
+        # the same as GameStateHistory.to_json_string
+        "history": json.dumps({"config": changes["config"], "tree": {"nodes": nodes_json, "current": changes["current"]}}),
+        "config": changes["config"],
+        "journal_generation": changes["journal_generation"],
+    })
+
+def write_file_atomically(filename, string):
+    """ Readers see either the old or the new file, even after a crash """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(string)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+@print_error_if_occured
+def write_session_changes(client_id, kind, changes):
+    """ Returns True if the changes are written. Is called outside of the game lock """
+    string = encode_session_changes(kind, changes)
+    os.makedirs("sessions", exist_ok=True)
+    journal_filename = f"sessions/{client_id}.journal"
+    if kind == 'snapshot':
+        write_file_atomically(f"sessions/{client_id}.json", string)
+        if os.path.exists(journal_filename):
+            os.remove(journal_filename)
+    else:
+        with open(journal_filename, "a") as f:
+            f.write(string + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    return True
+
+def session_exists(client_id):
+    return os.path.exists(f"sessions/{client_id}.json")
+
+def select_games_to_hibernate(games, idle_timeout, max_games):
+    """ Returns ids of the games idle for longer than idle_timeout seconds and of the least recently used games over max_games """
+    now = time.monotonic()
+    games_by_activity = sorted(games.items(), key=lambda item: item[1]['last_activity'])
+    n_games_over_budget = len(games) - max_games
+    return [
+        client_id for i, (client_id, game_data) in enumerate(games_by_activity)
+        if i < n_games_over_budget or now - game_data['last_activity'] > idle_timeout
+    ]
+
+def hibernate_game(client_id, game_data, compaction_entries):
+    """
+    Saves the game before it is dropped from memory, it is loaded back by load_or_create_game_data on the next operation.
+    Returns False if the game could not be saved and must be kept. Must be called under game_data['lock']
+    """
+    changes = collect_session_changes(game_data, compaction_entries)
+    if changes is not None and not write_session_changes(client_id, *changes):
+        game_data['needs_snapshot'] = True
+        return False
+    game_data['hibernated'] = True
+    return True
+
+@print_error_if_occured
+def load_game_session(client_id):
+    """ Restores the game from the snapshot and the journal, returns None if it has not been saved """
+    filename = f"sessions/{client_id}.json"
+    if not os.path.exists(filename):
+        return None
+    
+    with open(filename, "r") as f:
+        data = json.load(f)
+    game_data = create_game_data(data['config'])
+    game_history = game_data['history']
+    game_history.load_from_json_string(data['history'])
+    # sessions saved before the view was owned by the web clients have the transformation
+    if 'transformation' in data:
+        game_data['transformation'] = Transformation.from_json(data['transformation'], data['config'])
+    game_data['journal_generation'] = data.get('journal_generation', 0)
+    
+    journal_filename = f"sessions/{client_id}.journal"
+    journal_entries = 0
+    if os.path.exists(journal_filename):
+        with open(journal_filename, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is incomplete if the server crashed while appending it,
+                    # the next save must not append to it, so it writes a snapshot and removes the journal
+                    game_data['needs_snapshot'] = True
+                    break
+                if entry["generation"] != game_data['journal_generation']:
+                    continue
+                if entry["first_node"] > len(game_history.tree.nodes):
+                    print(f"Journal of {client_id} has a gap, it is replayed only up to it")
+                    game_data['needs_snapshot'] = True
+                    break
+                game_history.tree.append_nodes_json(entry["nodes"][len(game_history.tree.nodes) - entry["first_node"]:])
+                game_history.switch_to_node(entry["current"])
+                if "transformation" in entry:
+                    game_data['transformation'] = Transformation.from_json(entry["transformation"], data['config'])
+                journal_entries += 1
+    
+    game_data['saved'] = {
+        'nodes': len(game_history.tree.nodes),
+        'current': game_history.current_node.node_id,
+        'journal_entries': journal_entries,
+    }
+    return game_data
+
+@print_error_if_occured
+def handle_web_input(data, game_history):
+    """ Web client owns the view, so it sends world coordinates and handles zoom and drag itself """
+    action_type = data.get('action_type')
+    actions = []
+    
+    if action_type == 'mouse_down_left':
+        actions.append({
+            'action_type': ActionType.MOUSE_DOWN_LEFT,
+            'x': data['x'],
+            'y': data['y']
+        })
+    elif action_type == 'mouse_down_right':
+        actions.append({
+            'action_type': ActionType.MOUSE_DOWN_RIGHT,
+            'x': data['x'],
+            'y': data['y']
+        })
+    elif action_type == 'mouse_move':
+        actions.append({
+            'action_type': ActionType.MOUSE_MOTION,
+            'x': data['x'],
+            'y': data['y']
+        })
+    elif action_type == 'key_down':
+        key_map = {
+            'control': K_LCTRL,
+            '1': K_1,
+            '2': K_2,
+            '3': K_3,
+            'a': K_a,
+            'b': K_b,
+            'c': K_c,
+            'd': K_d,
+            'e': K_e,
+            'f': K_f,
+            'g': K_g,
+            'h': K_h,
+            'i': K_i,
+            'j': K_j,
+            'k': K_k,
+            'l': K_l,
+            'm': K_m,
+            'n': K_n,
+            'o': K_o,
+            'p': K_p,
+            'r': K_r,
+            's': K_s,
+            't': K_t,
+            'u': K_u,
+            'v': K_v,
+            'w': K_w,
+            'x': K_x,
+            'y': K_y,
+            'z': K_z,
+        }
+        if data['key'] in key_map and data['key'] not in ['z', 'y']:
+            actions.append({
+                'action_type': ActionType.KEY_DOWN,
+                'key': key_map[data['key']]
+            })
+        elif data['key'] == 'z':
+            actions.append({
+                'action_type': ActionType.UNDO
+            })
+        elif data['key'] == 'y':
+            actions.append({
+                'action_type': ActionType.REDO
+            })
+    
+    return actions
+
+@print_error_if_occured
+@metrics.serialization_time.time()
+def game_state_to_dict(game_state, transformation, config, detail_scale=1):
+    """
+    View-independent snapshot of the game: all the shapes are in world coordinates and every client applies its own view,
+    so one snapshot serves every member of the room.
+    Geometry is detailed for detail_scale, the largest zoom of the room members rounded up to a power of two
+    """
+    lod = transformation.level_of_detail(game_state.stone_radius, scale=detail_scale)
+    draw_list = game_state.get_draw_list(lod)
+    polygons_list = [shape.polygon for shape in draw_list if type(shape) == PolygonShape]
+    
+    # all the polygon vertices are taken at once, then split back into polygons
+    coords, polygon_indexes = shapely.get_coordinates(shapely.get_exterior_ring(polygons_list), return_index=True)
+    coords = coords.astype(np.float32)
+    offsets = np.searchsorted(polygon_indexes, np.arange(len(polygons_list) + 1))
+    
+    shapes = []
+    polygon_index = 0
+    for shape in draw_list:
+        if type(shape) == PolygonShape:
+            shapes.append({
+                'kind': 'polygon',
+                'points': coords[offsets[polygon_index]:offsets[polygon_index + 1]],
+                'color': shape.color
+            })
+            polygon_index += 1
+        elif type(shape) == Circle:
+            if "_suggestion" in shape.color:
+                # the suggestion stone is snapped and drawn by the clients themselves, see 'snapping'
+                continue
+            shapes.append({'kind': 'circle', 'x': shape.x, 'y': shape.y, 'r': shape.r, 'width': shape.width, 'color': shape.color})
+        else:
+            shapes.append({'kind': 'glyph', 'glyph': shape.kind, 'x': shape.x, 'y': shape.y, 'size': shape.size, 'color': shape.color})
+    
+    return {
+        'shapes': shapes,
+        'info': game_state.get_info(),
+        'background': game_state.background_to_render_list[game_state.background_to_render_index],
+        'board_style': game_state.board_to_render_list[game_state.board_to_render_index],
+        'snapping': pack_snapping(game_state.get_snapping_data()),
+    }
+
+def make_state_update(game_data, keyframe=False):
+    """
+    Serializes the current state of the game as a delta (or keyframe) against the last state sent to the room.
+    The game is serialized only if it has changed since the last update: the same game state version, hover quality and detail scale
+    give None (nothing to send), or the memoized keyframe of the current version if keyframe is True
+    """
+    game_history = game_data['history']
+    game_history.update(None)
+    game_state = game_history.current_game_state
+    detail_scale = max(game_data.get('detail_scales', dict()).values(), default=1)
+    serialization_key = (game_state.version, game_state.hover_quality, detail_scale)
+    state_differ = game_data['state_differ']
+    if state_differ.version > 0 and serialization_key == game_data.get('serialization_key'):
+        return state_differ.make_keyframe() if keyframe else None
+    
+    state = game_state_to_dict(game_state, game_data['transformation'], game_history.config, detail_scale)
+    game_data['serialization_key'] = serialization_key
+    state_update = state_differ.make_update(state)
+    if keyframe and state_update['type'] != 'keyframe':
+        state_update = state_differ.make_keyframe()
+    return state_update
+
+def apply_game_action(game_data, data):
+    """ Applies non mouse_move action. Returns (event name, payload) to emit besides the state update or None """
+    game_history = game_data['history']
+    
+    action_type = data.get('action_type')
+    
+    # Handle special actions
+    if action_type == 'save_game':
+        json_str = game_history.to_json_string()
+        return 'save_game', {
+            'type': 'save_game',
+            'game_data': json_str
+        }
+    elif action_type == 'load_game':
+        game_data_str = data['game_data']
+        game_history.load_from_json_string(game_data_str)
+        # Update game data
+        game_data['config'] = game_history.config
+        # the tree is replaced, so the journal can not continue it
+        game_data['needs_snapshot'] = True
+    else:
+        actions = handle_web_input(data, game_history)
+        for action in actions:
+            if all(elem not in action or action.get(elem, None) is not None for elem in ["x", "y"]):
+                game_history.update(action)
+    return None
+
+def apply_mouse_moves(game_data, buffer):
+    """ Applies batched mouse_move actions as one, only the last position matters for the hover """
+    game_history = game_data['history']
+    game_history.update({
+        'action_type': ActionType.MOUSE_MOTION,
+        'x': buffer[-1]['x'],
+        'y': buffer[-1]['y'],
+    })
+
+
+# action types of the web client, the others are counted as 'other' in the metrics
+WEB_ACTION_TYPES = {'mouse_down_left', 'mouse_down_right', 'mouse_move', 'key_down', 'save_game', 'load_game'}
+
+def observe_action_latencies(actions):
+    """ Actions are stamped with 'received_time' (time.time()) by the server, the latency is up to their update, called only when it is sent """
+    now = time.time()
+    for action in actions:
+        if 'received_time' in action:
+            action_type = action.get('action_type')
+            metrics.action_latency.observe(now - action['received_time'], action_type if action_type in WEB_ACTION_TYPES else 'other')
+
+
+def run_game_operation(game_data, operation, data):
+    """
+    Runs an operation requested by the web process on the game, returns list of (event name, payload) to emit.
+    Operations:
+        'register': data is unused, the full state is sent in 'init' event, the keyframe of the current version is reused if there is one
+        'tick': data is {'actions': list of game_action payloads, 'mouse_moves': list of mouse_move payloads to apply as one,
+                         'hover_quality': HoverQuality of the update if there are no actions},
+                actions are applied in order, then the mouse moves, and one state update is sent if the game has changed,
+                the update has 'action_ids' of the applied actions that carry 'action_id' (see loadtest.py)
+        'keyframe': data is unused, the full state is sent to the client that missed a delta
+        'view': data is {'sid', 'detail_scale'} of a room member, geometry is detailed for the largest one. None detail_scale removes the member
+    """
+    if operation == 'register':
+        state_differ = game_data['state_differ']
+        return [('init', {
+            'type': 'init',
+            'state': state_differ.make_keyframe() if state_differ.version > 0 else make_state_update(game_data, keyframe=True),
+            'config': game_data['config'],
+            'glyph_templates': {kind: list(get_glyph_polygon(kind, 0, 0, 1).exterior.coords) for kind in GLYPH_KINDS}
+        })]
+    if operation == 'tick':
+        events = []
+        for action in data['actions']:
+            event = apply_game_action(game_data, action)
+            if event is not None:
+                events.append(event)
+        game_state = game_data['history'].current_game_state
+        if not data['actions']:
+            game_state.hover_quality = HoverQuality(data.get('hover_quality', HoverQuality.full))
+        try:
+            if data['mouse_moves']:
+                apply_mouse_moves(game_data, data['mouse_moves'])
+            state_update = make_state_update(game_data)
+            if state_update is not None:
+                metrics.payload_size.observe(packed_size(state_update))
+                update = {
+                    'type': 'update',
+                    'state': state_update
+                }
+                action_ids = [action['action_id'] for action in data['actions'] if 'action_id' in action]
+                if action_ids:
+                    update['action_ids'] = action_ids
+                events.append(('update', update))
+                # without an update nothing has reached the clients, so there is no latency to observe
+                observe_action_latencies(data['actions'] + data['mouse_moves'])
+        finally:
+            game_state.hover_quality = HoverQuality.full
+        return events
+    if operation == 'view':
+        detail_scales = game_data.setdefault('detail_scales', dict())
+        if data['detail_scale'] is None:
+            detail_scales.pop(data['sid'], None)
+        else:
+            detail_scales[data['sid']] = data['detail_scale']
+        return []
+    if operation == 'keyframe':
+        return [('update', {
+            'type': 'update',
+            'state': game_data['state_differ'].make_keyframe()
+        })]
+    raise ValueError(f"Unknown game operation: {operation}")
@@ -1,13 +1,16 @@
 from typing import Literal, NamedTuple, Tuple, Dict
+from functools import lru_cache
+import itertools
 
 import pygame
 import shapely
 import math
 
 from handle_input import ActionType
+import metrics
 from utils import *
 from stones_structure import MyCache
-from enum import Enum
+from enum import Enum, IntEnum
 
 
 class Stone:
@@ -44,6 +47,57 @@ class Stone:
     __repr__ = __str__
 
 
+@lru_cache(maxsize=16)
+def calculate_board_geometry(board_polygon, stone_radius):
+    """ Board geometry is the same for all the game states, so it is shared between them """
+    board = shapely.Polygon(board_polygon).normalize()
+    board_inner = shapely.Polygon(shapely.intersection(board, board.exterior.buffer(stone_radius * (1 + 1e-4))).interiors[0]).normalize()
+    return board, board_inner
+
+
+class Circle(NamedTuple):
+    x: float
+    y: float
+    r: float
+    color: str
+    width: float = 0  # 0 means filled circle, otherwise it is the width of the outline
+
+
+class Glyph(NamedTuple):
+    kind: str  # one of GLYPH_KINDS
+    x: float
+    y: float
+    size: float  # radius of the stone the glyph is drawn on
+    color: str
+
+
+class PolygonShape(NamedTuple):
+    polygon: shapely.Polygon
+    color: str
+
+
+GLYPH_KINDS = ["cross", "ko"]
+
+# versions of all the game states are taken from one counter, so a replaced game state (undo, redo, load) never repeats a version
+_state_versions = itertools.count(1)
+
+
+def get_glyph_polygon(kind, x, y, size):
+    if kind == "cross":
+        return get_cross_polygon(x, y, (2**0.5) * size / 8, size / 16)
+    if kind == "ko":
+        return get_k_polygon(x, y, size / 2, size / 10)
+    raise ValueError(f"Unknown glyph: {kind}")
+
+
+class HoverQuality(IntEnum):
+    """ Levels of the hover preview quality under load, every level also skips the work of the previous ones """
+    full = 0
+    no_live_territory = 1  # territory and score are not recalculated on hover, unless the territory is shown
+    no_small_libreties = 2  # small librety highlighters are not drawn on hover
+    low_hover_rate = 3  # hovers are sent at a lower rate, see quality_governor.py
+
+
 class PlacementsModes(Enum):
     nearest_possible = "Nearest possible"
     snap_to_my_color = "Snap to my color"
@@ -74,6 +128,9 @@ class GameState:
         self.marking_dead_mode = [False, False]
         self.suggestion_stone_mode = [True, True]
         self.dont_show_suggestion_stone = False
+        self.hover_quality = HoverQuality.full  # is lowered by the server only for hover updates, committed moves are always exact
+        self.is_territory_stale = False  # territory was skipped by a low quality hover, it is recalculated by the next full quality update
+        self.version = next(_state_versions)  # is increased whenever what is drawn may have changed, see update
         self.fake_stone_mode = [False, False]
         self.fake_stones = [[], []]
         self.ko_stones = []
@@ -91,10 +148,11 @@ class GameState:
 
         self.config = config
         self.stone_radius = config["stone_radius"]
+        self.position_hash_quantum = config.get("position_hash_quantum", default_config["position_hash_quantum"])
+        self.position_hash = calculate_position_hash(self.placed_stones, self.position_hash_quantum)
 
         delta_x, delta_y = calculate_deltax_deltay(config)
-        self.board = shapely.Polygon([[delta_x + elem_x, delta_y + elem_y] for elem_x, elem_y in config["board_polygon"]]).normalize()
-        self.board_inner = shapely.Polygon(shapely.intersection(self.board, self.board.exterior.buffer(self.stone_radius * (1 + 1e-4))).interiors[0]).normalize()
+        self.board, self.board_inner = calculate_board_geometry(tuple((delta_x + elem_x, delta_y + elem_y) for elem_x, elem_y in config["board_polygon"]), self.stone_radius)
         self.previous_move_action = {"x": 0, "y": 0}
         
         self.cached_stone_structures = MyCache(stone_radius=self.stone_radius, board=self.board)
@@ -165,7 +223,29 @@ class GameState:
     def is_the_game_over(self):
         return self.passes_counter >= 2
     
+    def _get_drawn_key(self):
+        """ Cheap summary of what the hover and the keys can change in the drawing """
+        suggestion = None if self.dont_show_suggestion_stone else (self.suggestion_stone.x, self.suggestion_stone.y, self.suggestion_stone.color)
+        # the cross of the marking dead mode follows the pointer
+        pointer = (self.previous_move_action["x"], self.previous_move_action["y"]) if self.marking_dead_mode[self.player_to_move] else None
+        return (
+            suggestion, pointer, self.is_territory_stale, self.player_to_move, self.passes_counter, self.actions_counter,
+            tuple(self.placement_modes), tuple(self.territory_mode), tuple(self.marking_dead_mode), tuple(self.suggestion_stone_mode),
+            tuple(self.fake_stone_mode), self.background_to_render_index, self.board_to_render_index,
+        )
+
     def update(self, action):
+        """ Applies the action, self.version is increased if the drawing may have changed """
+        if action is not None and action["action_type"] in [ActionType.MOUSE_DOWN_LEFT, ActionType.MOUSE_DOWN_RIGHT]:
+            self._update(action)
+            self.version = next(_state_versions)
+            return
+        drawn_key = self._get_drawn_key()
+        self._update(action)
+        if self._get_drawn_key() != drawn_key:
+            self.version = next(_state_versions)
+
+    def _update(self, action):
         self.update_suggestion_stone_status()
         if action is None:
             self.handle_move()
@@ -225,15 +305,17 @@ class GameState:
         elif action["key"] == pygame.K_q:
             exit()
 
-    def _snap_stone(self, x, y):
+    def _get_snap_color(self):
         mode = list(PlacementsModes)[self.placement_modes[self.player_to_move]]
         if mode == PlacementsModes.nearest_possible:
-            snap_color = None
-        else:
-            if ((self.player_to_move == 0) == (mode == PlacementsModes.snap_to_my_color)):
-                snap_color = self.colors[0]
-            else:
-                snap_color = self.colors[1]
+            return None
+        if ((self.player_to_move == 0) == (mode == PlacementsModes.snap_to_my_color)):
+            return self.colors[0]
+        return self.colors[1]
+
+    @metrics.snap_time.time()
+    def _snap_stone(self, x, y):
+        snap_color = self._get_snap_color()
         
         if self.dont_show_suggestion_stone:
             return None, None
@@ -244,17 +326,41 @@ class GameState:
             print(f"{self.cached_stone_structures.get_structure("for_snapping").get_stones() = }")
             raise e
     
+    def get_snapping_data(self):
+        """ Everything needed to snap the suggestion stone without the game state, see web_protocol.snap_point """
+        structure = self.cached_stone_structures.get_structure("for_snapping")
+        is_fake_stone_mode = self.fake_stone_mode[self.player_to_move]
+        return {
+            "stones": [(stone.x, stone.y) for stone in structure.get_stones()],
+            "colors": [stone.color for stone in structure.get_stones()],
+            "librety_intervals": structure.get_librety_intervals(),
+            "stone_radius": self.stone_radius,
+            "snap_color": self._get_snap_color(),
+            "is_hidden": self.is_the_game_over() or self.marking_dead_mode[self.player_to_move] or not self.suggestion_stone_mode[self.player_to_move],
+            "is_fake_stone_mode": is_fake_stone_mode,
+            "suggestion_color": self.colors[self.player_to_move] + "_suggestion" + ("_hollow" if is_fake_stone_mode else ""),
+            "board_inner": list(self.board_inner.exterior.coords),
+        }
+    
     def handle_move(self, action=None):
         x, y = self._snap_stone(self.previous_move_action["x"], self.previous_move_action["y"])
         if x is None or y is None:
             self.dont_show_suggestion_stone = True
+            if self.is_territory_stale and self.hover_quality < HoverQuality.no_live_territory:
+                self.update_territory_structure()
+                self._calculate_territory()
+                self.is_territory_stale = False
             return
         self.suggestion_stone = Stone(x, y, self.colors[self.player_to_move] + "_suggestion")
         
         self.update_preview_structure()
+        if self.hover_quality >= HoverQuality.no_live_territory and not self.territory_mode[self.player_to_move]:
+            self.is_territory_stale = True
+            return
         self.update_territory_structure()
 
         self._calculate_territory()
+        self.is_territory_stale = False
     
     def get_active_stones(self):
         # if self.is_the_game_over():
@@ -329,6 +435,7 @@ class GameState:
 
         new_stone = Stone(x=x, y=y, color=self.colors[self.player_to_move])
         self.placed_stones.append(new_stone)
+        self._update_position_hash(new_stone)
 
         current_player_color = self.colors[self.player_to_move]
         opponent_color = self.colors[(self.player_to_move + 1) % 2]
@@ -374,11 +481,58 @@ class GameState:
             "actions_counter": self.actions_counter,
             "player_to_move": self.player_to_move,
             "passes_counter": self.passes_counter,
+            "position_hash": self.position_hash,
         }
 
     def get_list_of_shapes_to_draw(self):
+        return self._split_and_hollow_polygons(self._get_list_of_shapes_to_draw())
+    
+    def get_draw_list(self, lod=None):
+        """
+        Returns list of typed draw primitives: stones are Circle-s, dead and ko marks are Glyph-s,
+        only the irregular shapes (board, borders, connections, territory, highlighters) are PolygonShape-s.
+        lod is Transformation.level_of_detail(...), if it is given, polygons are tessellated and simplified
+        just enough for the current zoom and the shapes outside of the viewport are culled.
+        """
+        self.update(action=None)
+        lod = lod or {"quad_segs": 16, "simplify_tolerance": 0, "min_highlight_size": 0, "viewport": None}
+        if self.territory_mode[self.player_to_move]:
+            shapes_under_stones, shapes_over_stones = self._get_list_of_territory_polygons(), []
+        else:
+            shapes_under_stones = self._get_list_of_border_zones() + self._get_list_of_border_stones(lod["quad_segs"]) + self._get_list_of_connections()
+            shapes_over_stones = []
+            if self.hover_quality < HoverQuality.no_small_libreties:
+                shapes_over_stones = self._get_list_of_librety_highliters(lod["quad_segs"], lod["min_highlight_size"])
+        
+        draw_list = (
+            self._to_polygon_shapes(shapes_under_stones, lod)
+            + self._get_list_of_stone_primitives()
+            + self._to_polygon_shapes(shapes_over_stones, lod)
+        )
+        if lod["viewport"] is not None:
+            draw_list = [shape for shape in draw_list if self._is_shape_in_viewport(shape, lod["viewport"])]
+        return draw_list
+    
+    @staticmethod
+    def _is_shape_in_viewport(shape, viewport):
+        min_x, min_y, max_x, max_y = viewport
+        if type(shape) == PolygonShape:
+            shape_min_x, shape_min_y, shape_max_x, shape_max_y = shape.polygon.bounds
+        else:
+            radius = shape.r if type(shape) == Circle else shape.size
+            shape_min_x, shape_min_y, shape_max_x, shape_max_y = shape.x - radius, shape.y - radius, shape.x + radius, shape.y + radius
+        return shape_min_x <= max_x and min_x <= shape_max_x and shape_min_y <= max_y and min_y <= shape_max_y
+    
+    def _to_polygon_shapes(self, shapes, lod):
+        polygons_and_colors = self._split_and_hollow_polygons(shapes)
+        polygons = [polygon for polygon, _ in polygons_and_colors]
+        if lod["simplify_tolerance"] > 0:
+            polygons = shapely.simplify(polygons, lod["simplify_tolerance"])
+        return [PolygonShape(polygon, color) for polygon, (_, color) in zip(polygons, polygons_and_colors) if type(polygon) == shapely.Polygon and not polygon.is_empty]
+    
+    def _split_and_hollow_polygons(self, shapes):
         polygons_list = []
-        for polygon_or_multipolygon, color in self._get_list_of_shapes_to_draw():
+        for polygon_or_multipolygon, color in shapes:
             if type(polygon_or_multipolygon) == shapely.Polygon:
                 polygons_list.append((polygon_or_multipolygon, color))
             elif type(polygon_or_multipolygon) == shapely.MultiPolygon:
@@ -419,8 +573,13 @@ class GameState:
         return stones_to_kill
     
     def _kill_group(self, group):
+        for i in group:
+            self._update_position_hash(self.placed_stones[i])
         self.placed_stones = [s for i, s in enumerate(self.placed_stones) if i not in group]
     
+    def _update_position_hash(self, added_or_removed_stone):
+        self.position_hash ^= stone_fingerprint(added_or_removed_stone.x, added_or_removed_stone.y, added_or_removed_stone.color, self.position_hash_quantum)
+    
     def _get_list_of_territory_polygons(self):
         self._calculate_territory()
         
@@ -428,14 +587,16 @@ class GameState:
         rt = list(zip(territory_structure.get_voronoi_polygons(), [elem.color.replace("_hollow", "") + "_territory" for elem in territory_structure.get_stones()])) 
         return rt
 
-    def _get_list_of_librety_highliters(self):
+    def _get_list_of_librety_highliters(self, quad_segs=8, min_highlight_size=0):
         rt = []
         preview_structure = self.cached_stone_structures.get_structure("preview")
         small_libreties_for_hightlighting = preview_structure.get_small_librety_intervals_in_xy_format(self.config["minimal_librety_angle_to_hightlight"])
         for i in range(preview_structure._n):
             stone_i = preview_structure[i]
             for xy_start, xy_end in small_libreties_for_hightlighting[i]:
-                rt.append((shapely.Polygon([[stone_i.x, stone_i.y], xy_start, xy_end]).buffer(self.stone_radius / 20), stone_i.color.replace("_hollow", "") + "_small_librety"))
+                if distance_squared(xy_start[0] - xy_end[0], xy_start[1] - xy_end[1]) < min_highlight_size ** 2:
+                    continue
+                rt.append((shapely.Polygon([[stone_i.x, stone_i.y], xy_start, xy_end]).buffer(self.stone_radius / 20, quad_segs=quad_segs), stone_i.color.replace("_hollow", "") + "_small_librety"))
         return rt
         
     def _get_list_of_stones_to_draw(self):
@@ -456,6 +617,23 @@ class GameState:
 
         return rt            
     
+    def _get_list_of_stone_primitives(self):
+        rt = []
+        for stone in self.get_active_stones():
+            if "_hollow" in stone.color:
+                rt.append(Circle(stone.x, stone.y, self.stone_radius, stone.color.replace("_hollow", ""), self.config["line_width"]))
+            else:
+                rt.append(Circle(stone.x, stone.y, self.stone_radius, stone.color))
+            if stone.is_marked():
+                rt.append(Glyph("cross", stone.x, stone.y, self.stone_radius, stone.secondary_color))
+            if stone.is_ko_attacker:
+                rt.append(Glyph("ko", stone.x, stone.y, self.stone_radius, "grey"))
+        if self.marking_dead_mode[self.player_to_move]:
+            if self.previous_move_action:
+                x, y = self.previous_move_action["x"], self.previous_move_action["y"]
+                rt.append(Glyph("cross", x, y, self.stone_radius, get_opposite_color(self.suggestion_stone.color, self.colors)))
+        return rt
+    
     def _get_list_of_connections(self):
         connections = []
         active_stones = self.get_active_stones()
@@ -479,11 +657,11 @@ class GameState:
                     connections.append((connection, stone2_color + "_connection_suggestion" + hollow_suffix))
         return connections
 
-    def _get_list_of_border_stones(self):
+    def _get_list_of_border_stones(self, quad_segs=16):
         rt = []
         voronoi_polygons = self.cached_stone_structures.get_structure("preview").get_voronoi_polygons()
         for stone, voro_poly in zip(self.get_active_stones(), voronoi_polygons):
-            border_indicator_stone = shapely.Point(stone.x, stone.y).buffer(self.stone_radius * 2)
+            border_indicator_stone = shapely.Point(stone.x, stone.y).buffer(self.stone_radius * 2, quad_segs=quad_segs)
             border_indicator_stone = shapely.intersection(border_indicator_stone, voro_poly)
             if stone.color == self.suggestion_stone.color:
                 rt.append((border_indicator_stone, self.suggestion_stone.color + "_border"))
@@ -499,6 +677,7 @@ class GameState:
             (self.board_inner, "board")
         ]
 
+    @metrics.territory_time.time()
     def _calculate_territory(self):
         self.not_marked_as_dead_stones = [stone for stone in self.get_active_stones() if not stone.is_marked() and not "_hollow" in stone.color]
         alive_voronoi_polygons = self.cached_stone_structures.get_structure("territory").get_voronoi_polygons()
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+
+
+STONE_FIELDS = ("x", "y", "color", "secondary_color", "is_ko_attacker")
+
+
+class GameTreeNode:
+    """
+    Node of the variations tree.
+    Stones are not stored in the node, only the difference with the parent node:
+    added_stones and removed_stones are tuples of stone records that are shared between all the nodes of the tree.
+    """
+    def __init__(self, node_id, parent, added_stones, removed_stones, info):
+        self.node_id = node_id
+        self.parent = parent
+        self.children = []
+        self.added_stones = added_stones
+        self.removed_stones = removed_stones
+        self.info = info  # GameState.to_json() without "stones"
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.last_visited_child = None
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(node_id = {self.node_id}, depth = {self.depth}, children = {[child.node_id for child in self.children]})"
+
+    __repr__ = __str__
+
+
+class GameTree:
+    """
+    Tree of game states, branches share common prefixes and stone records.
+    Memory of a node is proportional to the number of stones changed by the move.
+    Stones of recently used nodes are kept materialized, so switching between close nodes is cheap.
+    """
+    def __init__(self, root_json, max_materialized_nodes=64):
+        self._stone_pool = dict()
+        self._materialized = OrderedDict()
+        self._max_materialized_nodes = max_materialized_nodes
+        self.nodes = []
+        self.root = self._create_node(None, self._intern_stones(root_json["stones"]), tuple(), root_json)
+
+    def _intern_stone(self, stone_dict):
+        stone_record = (
+            stone_dict["x"],
+            stone_dict["y"],
+            stone_dict["color"],
+            stone_dict.get("secondary_color") or stone_dict["color"],
+            stone_dict.get("is_ko_attacker", False),
+        )
+        return self._stone_pool.setdefault(stone_record, stone_record)
+
+    def _intern_stones(self, stone_dicts):
+        return tuple(self._intern_stone(stone_dict) for stone_dict in stone_dicts)
+
+    def _create_node(self, parent, added_stones, removed_stones, game_state_json):
+        info = {key: value for key, value in game_state_json.items() if key != "stones"}
+        node = GameTreeNode(len(self.nodes), parent, added_stones, removed_stones, info)
+        self.nodes.append(node)
+        if parent is not None:
+            parent.children.append(node)
+        return node
+
+    def _remember_materialized(self, node, stones):
+        self._materialized[node.node_id] = stones
+        self._materialized.move_to_end(node.node_id)
+        while len(self._materialized) > self._max_materialized_nodes:
+            self._materialized.popitem(last=False)
+
+    def get_stones(self, node):
+        """ Returns tuple of stone records of the node """
+        if node.node_id in self._materialized:
+            self._materialized.move_to_end(node.node_id)
+            return self._materialized[node.node_id]
+
+        path = []
+        ancestor = node
+        while ancestor is not None and ancestor.node_id not in self._materialized:
+            path.append(ancestor)
+            ancestor = ancestor.parent
+
+        # dict is used as an ordered multiset: stone record -> count
+        stones_counter = dict()
+        if ancestor is not None:
+            for stone in self._materialized[ancestor.node_id]:
+                stones_counter[stone] = stones_counter.get(stone, 0) + 1
+
+        for path_node in reversed(path):
+            for stone in path_node.removed_stones:
+                stones_counter[stone] -= 1
+                if not stones_counter[stone]:
+                    del stones_counter[stone]
+            for stone in path_node.added_stones:
+                stones_counter[stone] = stones_counter.get(stone, 0) + 1
+
+        stones = tuple(stone for stone, count in stones_counter.items() for _ in range(count))
+        self._remember_materialized(node, stones)
+        return stones
+
+    def get_json(self, node):
+        """ Returns the node in the GameState.to_json() format """
+        return {"stones": [dict(zip(STONE_FIELDS, stone)) for stone in self.get_stones(node)]} | node.info
+
+    def add_child(self, parent, game_state_json):
+        """ Adds a move to the parent node. If the same move has been already made, existing child is returned """
+        stones = self._intern_stones(game_state_json["stones"])
+        parent_stones_counter = dict()
+        for stone in self.get_stones(parent):
+            parent_stones_counter[stone] = parent_stones_counter.get(stone, 0) + 1
+
+        added_stones = []
+        for stone in stones:
+            if parent_stones_counter.get(stone, 0) > 0:
+                parent_stones_counter[stone] -= 1
+            else:
+                added_stones.append(stone)
+        removed_stones = tuple(stone for stone, count in parent_stones_counter.items() for _ in range(count))
+        added_stones = tuple(added_stones)
+
+        info = {key: value for key, value in game_state_json.items() if key != "stones"}
+        for child in parent.children:
+            if child.info == info and sorted(child.added_stones) == sorted(added_stones) and sorted(child.removed_stones) == sorted(removed_stones):
+                return child
+
+        child = self._create_node(parent, added_stones, removed_stones, game_state_json)
+        self._remember_materialized(child, stones)
+        return child
+
+    def path_to_root(self, node):
+        """ Returns list of nodes from the root to the node """
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        return path[::-1]
+
+    @staticmethod
+    def node_to_json(node):
+        return {
+            "parent": None if node.parent is None else node.parent.node_id,
+            "added": [dict(zip(STONE_FIELDS, stone)) for stone in node.added_stones],
+            "removed": [dict(zip(STONE_FIELDS, stone)) for stone in node.removed_stones],
+            "info": node.info,
+        }
+
+    def append_nodes_json(self, nodes_json):
+        """ Adds nodes in the node_to_json format, their parents must be already in the tree """
+        for node_json in nodes_json:
+            node = self._create_node(
+                self.nodes[node_json["parent"]],
+                self._intern_stones(node_json["added"]),
+                self._intern_stones(node_json["removed"]),
+                node_json["info"],
+            )
+            node.parent.last_visited_child = node
+
+    def to_json(self, current_node):
+        return {
+            "nodes": [self.node_to_json(node) for node in self.nodes],
+            "current": current_node.node_id,
+        }
+
+    @staticmethod
+    def from_json(json):
+        """ Returns the tree and its current node """
+        nodes_json = json["nodes"]
+        tree = GameTree({"stones": nodes_json[0]["added"]} | nodes_json[0]["info"])
+        tree.append_nodes_json(nodes_json[1:])
+        return tree, tree.nodes[json["current"]]
+
+    @staticmethod
+    def from_history(history):
+        """ Builds a tree with a single branch from the list of GameState.to_json() """
+        tree = GameTree(history[0])
+        node = tree.root
+        for game_state_json in history[1:]:
+            child = tree.add_child(node, game_state_json)
+            node.last_visited_child = child
+            node = child
+        return tree, node
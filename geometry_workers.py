@@ -0,0 +1,162 @@
+"""
+Pool of worker processes that own the game states, so the geometry of different games runs on different cores.
+Games are sharded by game id: all the operations of a game go to the same worker, in order,
+so a worker processes its games one operation at a time and needs no locks.
+Workers hibernate their idle games to the sessions and load them back on the next operation,
+report the hibernated games and send their metrics to the web process with the same period. The duration of every tick is sent back for the tick scheduler.
+The web process only routes operations and emits the results. Everything runs locally on multiprocessing queues.
+"""
+import hashlib
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+import metrics
+import utils
+from game_session import load_or_create_game_data, run_game_operation, collect_session_changes, write_session_changes, select_games_to_hibernate, hibernate_game, session_exists
+
+
+# how often a worker looks for idle games to hibernate, in seconds
+HIBERNATION_CHECK_INTERVAL = 5
+
+
+def _hibernate_idle_games(games):
+    """ Returns ids of the hibernated games """
+    config = utils.default_config
+    hibernated_ids = []
+    for client_id in select_games_to_hibernate(games, config["idle_game_timeout"], config["max_games_in_memory"]):
+        if hibernate_game(client_id, games[client_id], config["journal_compaction_entries"]):
+            del games[client_id]
+            hibernated_ids.append(client_id)
+    return hibernated_ids
+
+
+def _worker_main(task_queue, results_queue):
+    games = dict()
+    last_hibernation_check_time = time.monotonic()
+    while True:
+        try:
+            task = task_queue.get(timeout=HIBERNATION_CHECK_INTERVAL)
+        except queue.Empty:
+            task = None
+        if time.monotonic() - last_hibernation_check_time > HIBERNATION_CHECK_INTERVAL:
+            hibernated_ids = _hibernate_idle_games(games)
+            if hibernated_ids:
+                results_queue.put(('hibernated', {'client_ids': hibernated_ids}, None))
+            # the web process serves the metrics of the workers too
+            results_queue.put(('metrics', {'source': multiprocessing.current_process().name, 'snapshot': metrics.snapshot()}, None))
+            last_hibernation_check_time = time.monotonic()
+        if task is None:
+            continue
+        
+        client_id, operation, data, target = task
+        if operation == 'stop':
+            return
+        start_time = time.monotonic()
+        try:
+            game_data = games.get(client_id)
+            if game_data is None:
+                if operation == 'save':
+                    continue
+                game_data = load_or_create_game_data(client_id, operation)
+                if game_data is None:
+                    continue
+                games[client_id] = game_data
+
+            if operation == 'save':
+                changes = collect_session_changes(game_data, utils.default_config["journal_compaction_entries"])
+                if changes is not None and not write_session_changes(client_id, *changes):
+                    game_data['needs_snapshot'] = True
+                continue
+
+            game_data['last_activity'] = time.monotonic()
+            for event_name, payload in run_game_operation(game_data, operation, data):
+                results_queue.put((event_name, payload, target))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if operation == 'tick':
+                # a skipped or failed tick is reported too, the scheduler does not tick the game again until then
+                results_queue.put(('tick_time', {'client_id': client_id, 'tick_time': time.monotonic() - start_time}, None))
+
+
+class GeometryWorkerPool:
+    def __init__(self, n_workers, emit, report_tick_time=None, report_hibernated=None):
+        """
+        emit(event_name, payload, target) is called in the web process for every result, target is kwargs of socketio.emit,
+        report_tick_time(client_id, tick_time) is called with the duration of every 'tick' in the worker,
+        report_hibernated(client_id) is called for every game hibernated by a worker
+        """
+        context = multiprocessing.get_context("spawn")
+        self._task_queues = [context.Queue() for _ in range(n_workers)]
+        self._results_queue = context.Queue()
+        self._processes = [
+            context.Process(target=_worker_main, args=(task_queue, self._results_queue), name=f"geometry-worker-{i}", daemon=True)
+            for i, task_queue in enumerate(self._task_queues)
+        ]
+        self._emit = emit
+        self._report_tick_time = report_tick_time
+        self._report_hibernated = report_hibernated
+        self._known_games_lock = threading.Lock()
+        # games in memory of the workers, a hibernated game is added again on its next operation
+        self.known_games = set()
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        threading.Thread(target=self._forward_results, name="geometry-workers-results", daemon=True).start()
+
+    def stop(self):
+        for task_queue in self._task_queues:
+            task_queue.put((None, 'stop', None, None))
+        for process in self._processes:
+            process.join()
+
+    def shard(self, client_id):
+        """
+        Not crc32: the server processes of launcher.py shard by crc32 of the id, and crc32 is linear (a salted one too),
+        so every process would use only some of its workers
+        """
+        return int.from_bytes(hashlib.blake2b(client_id.encode(), digest_size=4).digest(), "big") % len(self._task_queues)
+
+    def has_game(self, client_id):
+        """ The game is in memory of a worker (or on its way there) """
+        with self._known_games_lock:
+            return client_id in self.known_games
+
+    def get_game_ids(self):
+        with self._known_games_lock:
+            return list(self.known_games)
+
+    def submit(self, client_id, operation, data=None, target=None):
+        """ Operations are the ones of game_session.run_game_operation and 'save' """
+        with self._known_games_lock:
+            if client_id not in self.known_games:
+                if operation != 'register' and not session_exists(client_id):
+                    return
+                self.known_games.add(client_id)
+        self._task_queues[self.shard(client_id)].put((client_id, operation, data, target))
+
+    def _forward_results(self):
+        while True:
+            event_name, payload, target = self._results_queue.get()
+            try:
+                if event_name == 'metrics':
+                    metrics.merge_snapshot(payload['source'], payload['snapshot'])
+                    continue
+                if event_name == 'hibernated':
+                    with self._known_games_lock:
+                        self.known_games.difference_update(payload['client_ids'])
+                    if self._report_hibernated is not None:
+                        for client_id in payload['client_ids']:
+                            self._report_hibernated(client_id)
+                    continue
+                if event_name == 'tick_time':
+                    if self._report_tick_time is not None:
+                        self._report_tick_time(payload['client_id'], payload['tick_time'])
+                    continue
+                self._emit(event_name, payload, target)
+            except Exception:
+                traceback.print_exc()
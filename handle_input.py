@@ -1,6 +1,6 @@
 from enum import Enum
 
-from pygame.locals import QUIT, MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION, KEYDOWN, K_z, KMOD_LCTRL, KMOD_RCTRL, USEREVENT
+from pygame.locals import QUIT, MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION, KEYDOWN, K_z, K_y, KMOD_LCTRL, KMOD_RCTRL, USEREVENT
 from pygame.key import get_mods
 import pygame_gui
 
@@ -16,6 +16,7 @@ class ActionType(Enum):
     MOUSE_MOTION = 'mouse_motion'
     MOUSE_SCROLL = 'mouse_scroll'
     UNDO = 'undo'
+    REDO = 'redo'
     FILEDIALOG_CONFIRMED = 'filedialog_confirmed'
 
 
@@ -101,6 +102,10 @@ def handle_input(events, xy_transformation_func):
                 action = {
                     'action_type': ActionType.UNDO
                 }
+            elif event.key == K_y:
+                action = {
+                    'action_type': ActionType.REDO
+                }
             else:
                 action = {
                     'action_type': ActionType.KEY_DOWN,
@@ -0,0 +1,53 @@
+"""
+Runs N server.py processes on one host, so every core serves games, without an external broker.
+Every game id is owned by one process (crc32 of the id, the geometry workers use another hash), the front on SUGO_PORT (5000)
+serves the page and tells the client where its game lives at /shard/<game_id>, the client connects there directly,
+and connects again when join_new_group moves it to a game of another process.
+The processes share the sessions directory, and relay Socket.IO messages through files (see server.make_client_manager).
+    python launcher.py [N]
+"""
+import os
+import subprocess
+import sys
+import zlib
+
+from flask import Flask, jsonify, render_template, request
+
+from utils import print_error_if_occured
+
+
+n_processes = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.environ.get("SUGO_SERVER_PROCESSES", os.cpu_count() or 1))
+front_port = int(os.environ.get("SUGO_PORT", 5000))
+# the server processes listen on the next ports after the front
+process_ports = [front_port + 1 + i for i in range(n_processes)]
+
+app = Flask(__name__)
+
+
+def shard_port(game_id):
+    return process_ports[zlib.crc32(game_id.encode()) % len(process_ports)]
+
+@app.route('/')
+@print_error_if_occured
+def index():
+    return render_template('index.html')
+
+@app.route('/shard/<game_id>')
+@print_error_if_occured
+def shard(game_id):
+    """ Address of the server process that owns the game """
+    return jsonify({"url": f"{request.scheme}://{request.host.rsplit(':', 1)[0]}:{shard_port(game_id)}"})
+
+
+if __name__ == '__main__':
+    os.makedirs("sessions", exist_ok=True)
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    environment = os.environ | {"SUGO_MESSAGE_QUEUE_DIR": os.environ.get("SUGO_MESSAGE_QUEUE_DIR", "message_queue")}
+    processes = [subprocess.Popen([sys.executable, server_path], env=environment | {"SUGO_PORT": str(port)}) for port in process_ports]
+    try:
+        app.run(host='0.0.0.0', port=front_port, threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
@@ -0,0 +1,254 @@
+"""
+Load generator for capacity planning: simulated players on python-socketio clients against a local server.py.
+    python loadtest.py --games 20 --players 2 --duration 60
+Every player registers to its game, streams mouse_move at --move-rate, places stones where the ghost stone snaps
+(web_protocol.snap_point on the shipped snapping data, like the web client), and now and then toggles the territory mode,
+undoes and saves. At the end it reports the throughput, the update latency percentiles, the received update bytes per second,
+the server CPU and the tick time of the games from /tick_stats.
+Every action carries an 'action_id' that the server echoes in the update that applied it, so the latency of an action is
+up to its own update, not to an update of a mouse move or of the other player. Actions that change nothing get no update
+and are reported as unanswered.
+By default server.py is started on --port in a temporary directory, so everything runs offline on localhost.
+--url targets an already running server instead, --server-pid gives its process for the CPU measurement.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+
+import numpy as np
+import socketio
+
+from web_protocol import packed_size, snap_point, unpack_snapping
+
+
+class LoadStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.actions_sent = 0
+        self.mouse_moves_sent = 0
+        self.updates_received = 0
+        self.keyframes_requested = 0
+        self.unanswered_actions = 0
+        self.bytes_received = 0
+        self.latencies = []
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def add_latencies(self, latencies):
+        with self._lock:
+            self.latencies.extend(latencies)
+
+
+class SimulatedPlayer:
+    def __init__(self, url, game_id, stats, args, seed):
+        self.url = url
+        self.game_id = game_id
+        self.stats = stats
+        self.args = args
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.client = socketio.Client(reconnection=False)
+        self.state_version = None
+        self.snapping = None
+        # action id -> send time of the actions whose update has not come yet, the ids are unique among the players
+        self.pending_action_times = dict()
+        self._action_ids = itertools.count()
+        self._pending_lock = threading.Lock()
+        self.pointer = (self.random.uniform(100, 500), self.random.uniform(100, 500))
+
+        self.client.on('init', self._on_update)
+        self.client.on('update', self._on_update)
+        self.client.on('save_game', lambda data: self.stats.add(bytes_received=len(data['game_data'])))
+
+    def _on_update(self, data):
+        now = time.perf_counter()
+        with self._pending_lock:
+            latencies = [now - self.pending_action_times.pop(action_id) for action_id in data.get('action_ids', []) if action_id in self.pending_action_times]
+        self.stats.add_latencies(latencies)
+
+        state = data['state']
+        self.stats.add(updates_received=1, bytes_received=packed_size(state))
+        if state['type'] == 'delta' and state['base_version'] != self.state_version:
+            self.stats.add(keyframes_requested=1)
+            self.client.emit('request_keyframe', {'client_id': self.game_id})
+            return
+        self.state_version = state['version']
+        if state.get('snapping'):
+            self.snapping = unpack_snapping(state['snapping'])
+
+    def _send_action(self, action):
+        action_id = f"{self.seed}_{next(self._action_ids)}"
+        with self._pending_lock:
+            self.pending_action_times[action_id] = time.perf_counter()
+        self.client.emit('game_action', {'client_id': self.game_id, 'action_id': action_id} | action)
+        self.stats.add(actions_sent=1)
+
+    def _move_pointer(self):
+        """ Random walk of the pointer over the board """
+        x, y = self.pointer
+        self.pointer = (min(max(x + self.random.gauss(0, 15), 0), 600), min(max(y + self.random.gauss(0, 15), 0), 600))
+
+    def _try_to_place_stone(self):
+        """ Clicks where the ghost stone is shown, like a player would """
+        if self.snapping is None:
+            return
+        point = snap_point(self.snapping, *self.pointer)
+        if point is None:
+            return
+        self._send_action({'action_type': 'mouse_down_left', 'x': point[0], 'y': point[1]})
+
+    def run(self, end_time):
+        self.client.connect(self.url, transports=['websocket'])
+        self.client.emit('register', self.game_id)
+        move_interval = 1 / self.args.move_rate
+        next_click_time = time.monotonic() + self.random.expovariate(1 / self.args.click_interval)
+        try:
+            while time.monotonic() < end_time:
+                time.sleep(move_interval)
+                self._move_pointer()
+                self.client.emit('game_action', {'client_id': self.game_id, 'action_type': 'mouse_move', 'x': self.pointer[0], 'y': self.pointer[1]})
+                self.stats.add(mouse_moves_sent=1)
+                if time.monotonic() < next_click_time:
+                    continue
+                next_click_time = time.monotonic() + self.random.expovariate(1 / self.args.click_interval)
+                dice = self.random.random()
+                if dice < 0.05:
+                    self._send_action({'action_type': 'key_down', 'key': 't'})
+                elif dice < 0.1:
+                    self._send_action({'action_type': 'key_down', 'key': 'z'})
+                elif dice < 0.12:
+                    self.client.emit('game_action', {'client_id': self.game_id, 'action_type': 'save_game'})
+                else:
+                    self._try_to_place_stone()
+        finally:
+            self.client.disconnect()
+            with self._pending_lock:
+                self.stats.add(unanswered_actions=len(self.pending_action_times))
+
+
+def process_tree_cpu_seconds(pid):
+    """ User and system CPU time of the process and its children (the geometry workers), None if /proc is not available """
+    try:
+        pids = [pid] + [int(entry) for entry in os.listdir("/proc") if entry.isdigit() and _read_proc_stat(int(entry))[1] == pid]
+        return sum(_read_proc_stat(process_id)[0] for process_id in pids)
+    except (OSError, IndexError, ValueError):
+        return None
+
+def _read_proc_stat(pid):
+    """ Returns (CPU seconds, parent pid) of the process """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return 0, None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), int(fields[1])
+
+
+def get_tick_times(url):
+    """ Game id -> seconds spent in its ticks since the server started, from /tick_stats. None if it is not available """
+    try:
+        with urlopen(f"{url}/tick_stats", timeout=10) as response:
+            return {game_id: game_stats["tick_time_total"] for game_id, game_stats in json.load(response).items()}
+    except (OSError, ValueError, KeyError) as error:
+        print(f"/tick_stats is not available: {error}")
+        return None
+
+
+def start_server(port):
+    """ Starts server.py in a temporary directory (for its sessions and its log) and waits until it listens """
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    directory = tempfile.mkdtemp(prefix="sugo-loadtest-")
+    log_path = os.path.join(directory, "server.log")
+    print(f"server.py log: {log_path}")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable, server_path], cwd=directory, env=os.environ | {"SUGO_PORT": str(port)}, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"server.py did not start on port {port}")
+
+
+def print_report(stats, duration, n_games, cpu_seconds, tick_times):
+    """ tick_times are the seconds spent in the ticks of every game during the test """
+    latencies = np.array(stats.latencies) * 1000
+    print(f"duration: {duration:.1f} s, games: {n_games}")
+    print(f"sent: {stats.actions_sent / duration:.1f} actions/s, {stats.mouse_moves_sent / duration:.1f} mouse moves/s")
+    print(f"received: {stats.updates_received / duration:.1f} updates/s, {stats.bytes_received / duration / 1024:.1f} KiB/s of update buffers, {stats.keyframes_requested} keyframes requested")
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"update latency: p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, max {latencies.max():.1f} ms ({len(latencies)} actions)")
+    print(f"unanswered actions (nothing changed, or still in flight at the end): {stats.unanswered_actions}")
+    if cpu_seconds is not None:
+        print(f"server CPU: {cpu_seconds / duration:.2f} cores")
+    if tick_times:
+        per_second = np.array(list(tick_times.values())) / duration * 1000
+        print(f"tick time per game: mean {per_second.mean():.1f}, p95 {np.percentile(per_second, 95):.1f}, max {per_second.max():.1f} ms per second ({len(tick_times)} of {n_games} games ticked)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--players", type=int, default=2, help="players per game")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--move-rate", type=float, default=30, help="mouse moves per second of a player")
+    parser.add_argument("--click-interval", type=float, default=2, help="mean seconds between the clicks and keys of a player")
+    parser.add_argument("--port", type=int, default=5099, help="port of the started server.py")
+    parser.add_argument("--url", help="url of a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the running server for the CPU measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server_process = None
+    url, server_pid = args.url, args.server_pid
+    if url is None:
+        server_process = start_server(args.port)
+        url, server_pid = f"http://127.0.0.1:{args.port}", server_process.pid
+
+    stats = LoadStats()
+    players = [
+        SimulatedPlayer(url, f"loadtest_{args.seed}_{game}", stats, args, seed=args.seed * 1000003 + game * args.players + player)
+        for game in range(args.games) for player in range(args.players)
+    ]
+    game_ids = {player.game_id for player in players}
+    tick_times_start = get_tick_times(url)
+    cpu_start = process_tree_cpu_seconds(server_pid) if server_pid else None
+    start_time = time.monotonic()
+    end_time = start_time + args.duration
+    threads = [threading.Thread(target=player.run, args=(end_time,), daemon=True) for player in players]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start_time
+        cpu_end = process_tree_cpu_seconds(server_pid) if server_pid else None
+        tick_times_end = get_tick_times(url)
+        tick_times = None
+        if tick_times_start is not None and tick_times_end is not None:
+            tick_times = {game_id: tick_time - tick_times_start.get(game_id, 0) for game_id, tick_time in tick_times_end.items() if game_id in game_ids}
+        print_report(stats, duration, args.games, cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None, tick_times)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == '__main__':
+    main()
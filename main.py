@@ -4,14 +4,16 @@ import json
 import utils
 import copy 
 import os
+import time
 
 import pygame
 from pygame.locals import *
 import pygame_gui
 import shapely
 
+from frame_timings import FrameTimings
 from game_history import GameStateHistory
-from rendering import render
+from rendering import render, draw_frame_timings, add_stage_time
 from handle_input import handle_input, ActionType
 from filedialog import FileDailog
 from transformation import Transformation
@@ -52,9 +54,13 @@ def main():
     if os.environ.get('PROFILING', '0') == '1':
         prof = None
     
+    frame_timings = FrameTimings(config["frame_timings_window"])
+    show_frame_timings = config["show_frame_timings"]
     while True:
+        stage_times = dict()
+        frame_start_time = start_time = time.perf_counter()
         if os.environ.get('PROFILING', '0') == '1':
-            if len(game_state.placed_stones) == 200:
+            if len(game_history.current_game_state.placed_stones) == 200:
                 prof = pyinstrument.Profiler()
                 prof.start()
         
@@ -72,7 +78,9 @@ def main():
             elif dialog_type_or_none == "save":
                 game_history.save_to_file(picked_path_of_none)
             
-        for action in handle_input(pygame_events, transformation.screen_to_world):
+        actions = handle_input(pygame_events, transformation.screen_to_world)
+        start_time = add_stage_time(stage_times, "input", start_time)
+        for action in actions:
             if action["action_type"] == ActionType.MOUSE_SCROLL:
                 transformation.update_self_zoom(action["x"], action["y"], config["zoom_speed"] * action["value"])
                 continue
@@ -88,6 +96,8 @@ def main():
             if action["action_type"] == ActionType.KEY_DOWN:
                 if action["key"] == pygame.K_r:
                     transformation.reset()
+                if action["key"] == pygame.K_F3:
+                    show_frame_timings = not show_frame_timings
                 if action["key"] == pygame.K_o:
                     filedialog.open_file_dialog("open")
                 elif action["key"] == pygame.K_s:
@@ -104,12 +114,22 @@ def main():
         
         game_history.update(None)
         game_history.current_game_state.update_background()
+        add_stage_time(stage_times, "update", start_time)
 
-        render(screen, game_history.current_game_state, config, transformation)
+        render(screen, game_history.current_game_state, config, transformation, stage_times)
+        if show_frame_timings:
+            start_time = time.perf_counter()
+            draw_frame_timings(screen, frame_timings, config)
+            add_stage_time(stage_times, "frame_timings", start_time)
+
+        start_time = time.perf_counter()
         manager.update(1 / config['fps'])
 
         manager.draw_ui(screen)
         pygame.display.flip()
+        add_stage_time(stage_times, "ui", start_time)
+        add_stage_time(stage_times, "frame", frame_start_time)
+        frame_timings.end_frame(stage_times, len(game_history.current_game_state.placed_stones))
         fpsClock.tick(config['fps'])
 
 
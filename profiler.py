@@ -0,0 +1,89 @@
+"""
+Sampling profiler of the live server, see /admin/profile in server.py.
+A background thread samples the stacks of all the threads of the process, so Socket.IO handlers, scheduler ticks
+and background tasks are profiled without a restart, and the profiled code is not slowed down by tracing.
+Threads mark the game they are working on with game_context, so a profile can be filtered to one game.
+The report is in the speedscope format (https://www.speedscope.app), one profile per thread.
+"""
+from contextlib import contextmanager
+import sys
+import threading
+import time
+
+
+# thread ident -> id of the game the thread is working on
+_thread_games = dict()
+# only one profile runs at a time
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def game_context(game_id):
+    """ Marks the samples of the current thread as the ones of the game """
+    ident = threading.get_ident()
+    previous_game_id = _thread_games.get(ident)
+    _thread_games[ident] = game_id
+    try:
+        yield
+    finally:
+        if previous_game_id is None:
+            _thread_games.pop(ident, None)
+        else:
+            _thread_games[ident] = previous_game_id
+
+
+def profile(seconds, interval=0.001, game_id=None):
+    """
+    Samples the stacks of the other threads every interval for seconds, only the ones working on game_id if it is given.
+    Returns speedscope file as a dict, or None if another profile is running
+    """
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        frames = []
+        frame_indexes = dict()  # (function name, file, first line) -> index in frames
+        thread_samples = dict()  # thread ident -> (stacks, weights)
+        own_ident = threading.get_ident()
+        start_time = previous_time = time.perf_counter()
+        while previous_time - start_time < seconds:
+            time.sleep(interval)
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or (game_id is not None and _thread_games.get(ident) != game_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_name, code.co_filename, code.co_firstlineno)
+                    frame_index = frame_indexes.get(key)
+                    if frame_index is None:
+                        frame_index = frame_indexes[key] = len(frames)
+                        frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+                    stack.append(frame_index)
+                    frame = frame.f_back
+                stacks, weights = thread_samples.setdefault(ident, ([], []))
+                stacks.append(stack[::-1])
+                weights.append(now - previous_time)
+            previous_time = now
+    finally:
+        _profile_lock.release()
+
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"sugo server{f', game {game_id}' if game_id is not None else ''}",
+        "exporter": "sugo profiler.py",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": thread_names.get(ident, str(ident)),
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": stacks,
+                "weights": weights,
+            }
+            for ident, (stacks, weights) in thread_samples.items()
+        ],
+    }
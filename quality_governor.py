@@ -0,0 +1,71 @@
+"""
+Load-adaptive quality of the hover previews on the server.
+Watches the smoothed tick time and tick latency of the scheduler: while they are over budget the hover quality is lowered
+one level at a time (see game_state.HoverQuality), when the load drops it is restored one level at a time.
+Only hover updates are degraded, ticks with actions are always computed at full quality.
+With the geometry workers the latency is observed when a tick is handed over and the tick time when the worker reports it.
+"""
+from game_state import HoverQuality
+
+
+class HoverQualityGovernor:
+    def __init__(self, time_budget, latency_budget, smoothing=0.1, degrade_after=10, restore_after=100):
+        """
+        time_budget and latency_budget are in seconds, load is low when both averages are under half of their budgets.
+        The level is lowered after degrade_after overloaded ticks in a row and raised after restore_after low load ticks in a row
+        """
+        self.time_budget = time_budget
+        self.latency_budget = latency_budget
+        self.smoothing = smoothing
+        self.degrade_after = degrade_after
+        self.restore_after = restore_after
+        self.level = HoverQuality.full
+        self.tick_time_average = 0
+        self.latency_average = 0
+        self.level_changes = 0
+        self._overloaded_ticks = 0
+        self._low_load_ticks = 0
+
+    def observe(self, tick_time, latency):
+        self.observe_latency(latency)
+        self.observe_tick_time(tick_time)
+
+    def observe_latency(self, latency):
+        """ Latency of a tick whose time comes later with observe_tick_time """
+        self.latency_average += self.smoothing * (latency - self.latency_average)
+
+    def observe_tick_time(self, tick_time):
+        """ Every tick time counts as one tick for degrade_after and restore_after """
+        self.tick_time_average += self.smoothing * (tick_time - self.tick_time_average)
+
+        if self.tick_time_average > self.time_budget or self.latency_average > self.latency_budget:
+            self._overloaded_ticks += 1
+            self._low_load_ticks = 0
+        elif self.tick_time_average < self.time_budget / 2 and self.latency_average < self.latency_budget / 2:
+            self._low_load_ticks += 1
+            self._overloaded_ticks = 0
+        else:
+            self._overloaded_ticks = self._low_load_ticks = 0
+
+        if self._overloaded_ticks >= self.degrade_after and self.level < max(HoverQuality):
+            self._set_level(self.level + 1)
+        elif self._low_load_ticks >= self.restore_after and self.level > HoverQuality.full:
+            self._set_level(self.level - 1)
+
+    def _set_level(self, level):
+        self.level = HoverQuality(level)
+        self.level_changes += 1
+        self._overloaded_ticks = self._low_load_ticks = 0
+        print(f"Hover quality is set to {self.level.name}")
+
+    def hover_rate_divisor(self):
+        """ Hover only ticks of a game are this times rarer than the rate cap """
+        return 2 if self.level >= HoverQuality.low_hover_rate else 1
+
+    def to_json(self):
+        return {
+            "level": self.level.name,
+            "tick_time_average": self.tick_time_average,
+            "latency_average": self.latency_average,
+            "level_changes": self.level_changes,
+        }
@@ -1,10 +1,12 @@
 import random
 import math
+import time
 from utils import default_config, calculate_deltax_deltay, remove_interior_if_it_exists
 
 import pygame
 import shapely
 from utils import colors
+from game_state import Circle, Glyph, get_glyph_polygon
 
 from render_tempates.background_water import render_water_background
 from render_tempates.real_board import create_real_board_surface
@@ -64,7 +66,7 @@ def render_cached_real_board(screen, config, delta_x, delta_y):
     board_display.blit(real_board_cached_surface, (0, 0))
     return board_display
 
-def render_board(screen, game_state, config, transformation):
+def render_board(screen, game_state, config, transformation, stage_times=None):
     import copy
     delta_x, delta_y = calculate_deltax_deltay(config)
     board_to_render = game_state.board_to_render_list[game_state.board_to_render_index]
@@ -87,26 +89,47 @@ def render_board(screen, game_state, config, transformation):
 
     # base_surface.blit(pygame.transform.scale(board_display, (corner3[0] - corner1[0], corner3[1] - corner1[1])), corner1)
     
-    for polygon, color in game_state.get_list_of_shapes_to_draw():
+    start_time = time.perf_counter()
+    lod = transformation.level_of_detail(game_state.stone_radius, (config['width'], config['height']))
+    draw_list = game_state.get_draw_list(lod)
+    start_time = add_stage_time(stage_times, "shapes", start_time)
+    for shape in draw_list:
+        if type(shape) == Circle:
+            center_x, center_y = transformation.world_to_screen(shape.x, shape.y)
+            width = max(1, round(transformation.world_to_screen_distance(shape.width))) if shape.width else 0
+            pygame.draw.circle(base_surface, colors[shape.color], (center_x - delta_x, center_y - delta_y), transformation.world_to_screen_distance(shape.r), width)
+            continue
+        
+        if type(shape) == Glyph:
+            polygon, color = get_glyph_polygon(shape.kind, shape.x, shape.y, shape.size), shape.color
+        else:
+            polygon, color = shape.polygon, shape.color
         if len(polygon.exterior.coords) > 2:
             tranformed_coords = [transformation.world_to_screen(elem[0], elem[1]) for elem in polygon.exterior.coords] # 
             pygame.draw.polygon(base_surface, colors[color], [[tcoord_x - delta_x, tcoord_y - delta_y] for tcoord_x, tcoord_y in tranformed_coords])
 
     screen.blit(base_surface, (delta_x, delta_y))
+    add_stage_time(stage_times, "board_polygons", start_time)
 
 def draw_info_panel(screen, game_state, config):
+    panel_width = 800
+    panel_x = (config['width'] - panel_width) / 2
+    panel_y = config['height'] - config["bottom_panel_width"] - 10
+    draw_panel(screen, game_state.get_info(), panel_x, panel_y, panel_width)
+
+def draw_frame_timings(screen, frame_timings, config):
+    """ Overlay of the rolling per-stage timings of the desktop client, see frame_timings.py """
+    draw_panel(screen, frame_timings.get_info(), 10, 10, 460)
+
+def draw_panel(screen, info, panel_x, panel_y, panel_width):
+    """ Half transparent panel with a "key: value" line for every item of the info dict """
     font_key = pygame.font.SysFont('Courier New', 14)
     font_value = pygame.font.SysFont('Courier New', 14)
     
-    info = game_state.get_info()
-    
-    panel_width = 800
     line_height = 20
     padding = 10
     
     panel_height = (len(info) * line_height) + (2 * padding)
-    panel_x = (config['width'] - panel_width) / 2
-    panel_y = config['height'] - config["bottom_panel_width"] - 10
     
     panel_surface = pygame.Surface((panel_width, panel_height), pygame.SRCALPHA)
     panel_surface.fill((0, 0, 0, 150))
@@ -138,9 +161,21 @@ def draw_info_panel(screen, game_state, config):
     screen.blit(panel_surface, (panel_x, panel_y))
 
 
-def render(screen, game_state, config, transformation):
+def add_stage_time(stage_times, stage, start_time):
+    """ Adds the seconds since start_time to stage_times[stage] if stage_times is given, returns the current time """
+    now = time.perf_counter()
+    if stage_times is not None:
+        stage_times[stage] = stage_times.get(stage, 0) + now - start_time
+    return now
+
+def render(screen, game_state, config, transformation, stage_times=None):
+    """ stage_times is a dict, if it is given the seconds of the background, shapes, board_polygons and info_panel stages are added to it """
+    start_time = time.perf_counter()
     screen.fill(colors.get('black'))
     render_background(screen, game_state, config)
-    render_board(screen, game_state, config, transformation)
+    add_stage_time(stage_times, "background", start_time)
+    render_board(screen, game_state, config, transformation, stage_times)
+    start_time = time.perf_counter()
     draw_info_panel(screen, game_state, config)
+    add_stage_time(stage_times, "info_panel", start_time)
     
\ No newline at end of file
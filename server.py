@@ -1,176 +1,201 @@
-from collections import defaultdict
+import hmac
 import json
+import math
 import threading
 import os
+import time
 import uuid
-import shapely
-from flask import Flask, render_template
-from flask_socketio import SocketIO, emit, join_room, leave_room
-from game_history import GameStateHistory
-from handle_input import ActionType
-from transformation import Transformation
-from pygame.locals import *
-import pygame
+from flask import Flask, Response, jsonify, render_template, request
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
+from game_session import load_or_create_game_data, run_game_operation, collect_session_changes, write_session_changes, session_exists, select_games_to_hibernate, hibernate_game
+from geometry_workers import GeometryWorkerPool
+import metrics
+import profiler
+from quality_governor import HoverQualityGovernor
+from tick_scheduler import TickScheduler
 import utils
+from utils import print_error_if_occured
 
 
+def make_client_manager():
+    """
+    SUGO_MESSAGE_QUEUE_DIR=path relays Socket.IO messages between the server processes of launcher.py
+    through files in that directory (kombu filesystem transport), so no external broker is needed
+    """
+    queue_dir = os.environ.get("SUGO_MESSAGE_QUEUE_DIR")
+    if not queue_dir:
+        return None
+    import socketio as python_socketio
+    transport_options = {
+        "data_folder_in": os.path.join(queue_dir, "data"),
+        "data_folder_out": os.path.join(queue_dir, "data"),
+        "control_folder": os.path.join(queue_dir, "control"),
+    }
+    for folder in transport_options.values():
+        os.makedirs(folder, exist_ok=True)
+    return python_socketio.KombuManager("filesystem://", channel="sugo", connection_options={"transport_options": transport_options})
 
-def print_error_if_occured(func):
-    def rt(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-    return rt
-
-
-@print_error_if_occured
-def save_game_session(client_id, game_data):
-    os.makedirs("sessions", exist_ok=True)
-    filename = f"sessions/{client_id}.json"
-    with open(filename, "w") as f:
-        json.dump({
-            "history": game_data['history'].to_json_string(),
-            "transformation": game_data['transformation'].to_json(),
-            "config": game_data['config']
-        }, f)
-
-@print_error_if_occured
-def load_game_session(client_id):
-    filename = f"sessions/{client_id}.json"
-    if os.path.exists(filename):
-        with open(filename, "r") as f:
-            data = json.load(f)
-            history = GameStateHistory(config=data['config'])
-            history.load_from_json_string(data['history'])
-            transformation = Transformation.from_json(data['transformation'])
-            return {
-                'history': history,
-                'transformation': transformation,
-                'config': data['config']
-            }
-    return None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", client_manager=make_client_manager())
 
+# games in memory, idle games are hibernated to their sessions and loaded back on the next operation
 games = {}
-lock = threading.Lock()
-# Setup mouse_move buffers for each client
-mouse_move_buffers = defaultdict(list)
+# games_lock guards only the registry (games dict).
+# Every game has its own game_data['lock'] that guards its state
+games_lock = threading.Lock()
+# Pool of geometry worker processes that own the games instead of this process, None if disabled (see SUGO_GEOMETRY_WORKERS)
+geometry_workers = None
 
-@print_error_if_occured
-def handle_web_input(data, transformation, game_history):
-    action_type = data.get('action_type')
-    actions = []
-    
-    if action_type == 'mouse_down_left':
-        x, y = transformation.screen_to_world(data['x'], data['y'])
-        actions.append({
-            'action_type': ActionType.MOUSE_DOWN_LEFT,
-            'x': x,
-            'y': y
-        })
-    elif action_type == 'mouse_down_right':
-        x, y = transformation.screen_to_world(data['x'], data['y'])
-        actions.append({
-            'action_type': ActionType.MOUSE_DOWN_RIGHT,
-            'x': x,
-            'y': y
-        })
-    elif action_type == 'mouse_move':
-        x, y = transformation.screen_to_world(data['x'], data['y'])
-        actions.append({
-            'action_type': ActionType.MOUSE_MOTION,
-            'x': x,
-            'y': y,
-            'rel_x': data['rel_x'],
-            'rel_y': data['rel_y'],
-            'is_control_pressed': data['is_control_pressed']
-        })
-    elif action_type == 'mouse_scroll':
-        actions.append({
-            'action_type': ActionType.MOUSE_SCROLL,
-            'x': data['x'],
-            'y': data['y'],
-            'value': data['value']
-        })
-    elif action_type == 'key_down':
-        key_map = {
-            'control': K_LCTRL,
-            '1': K_1,
-            '2': K_2,
-            '3': K_3,
-            'a': K_a,
-            'b': K_b,
-            'c': K_c,
-            'd': K_d,
-            'e': K_e,
-            'f': K_f,
-            'g': K_g,
-            'h': K_h,
-            'i': K_i,
-            'j': K_j,
-            'k': K_k,
-            'l': K_l,
-            'm': K_m,
-            'n': K_n,
-            'o': K_o,
-            'p': K_p,
-            'r': K_r,
-            's': K_s,
-            't': K_t,
-            'u': K_u,
-            'v': K_v,
-            'w': K_w,
-            'x': K_x,
-            'y': K_y,
-            'z': K_z,
-        }
-        if data['key'] in key_map and not data['key'] == 'z':
-            actions.append({
-                'action_type': ActionType.KEY_DOWN,
-                'key': key_map[data['key']]
-            })
-        elif data['key'] == 'z':
-            actions.append({
-                'action_type': ActionType.UNDO
-            })
-    elif action_type == 'reset_view':
-        transformation.reset()
-    
-    return actions
+
+def get_game_data(client_id):
+    with games_lock:
+        return games.get(client_id)
+
+def has_game(client_id):
+    """ The game is in memory or can be loaded from its session """
+    if geometry_workers is not None and geometry_workers.has_game(client_id):
+        return True
+    return get_game_data(client_id) is not None or session_exists(client_id)
+
+def has_game_in_memory(client_id):
+    """ Without the geometry workers the game is in this process, otherwise in a worker (which skips 'view' of a game it has just hibernated) """
+    if geometry_workers is not None:
+        return geometry_workers.has_game(client_id)
+    return get_game_data(client_id) is not None
+
+# emit(event_name, payload, to=..., room=...) of the server that the game events are sent with, async_server.py sets its own
+emit_event = socketio.emit
+
+def emit_game_event(event_name, payload, target):
+    emit_event(event_name, payload, **target)
 
 @print_error_if_occured
-def game_state_to_dict(game_state, transformation, config):
-    polygons = []
-    for polygon_or_multipolygon, color in game_state.get_list_of_shapes_to_draw():
-        if hasattr(polygon_or_multipolygon, 'geoms'):  # MultiPolygon
-            for polygon in polygon_or_multipolygon.geoms:
-                polygons.append({
-                    'points': [transformation.world_to_screen(wx, wy) for wx, wy in polygon.exterior.coords],
-                    'color': color
-                })
-        else:  # Single Polygon
-            polygons.append({
-                'points': [transformation.world_to_screen(wx, wy) for wx, wy in polygon_or_multipolygon.exterior.coords],
-                'color': color
-            })
+def run_game_operation_locally(client_id, operation, data, target):
+    while True:
+        game_data = get_game_data(client_id)
+        if game_data is None:
+            # the game is loaded or created outside of the registry lock, so other games are not blocked
+            new_game_data = load_or_create_game_data(client_id, operation)
+            if new_game_data is None:
+                return
+            with games_lock:
+                game_data = games.setdefault(client_id, new_game_data)
+        
+        lock_wait_start_time = time.perf_counter()
+        with game_data['lock'], profiler.game_context(client_id):
+            metrics.lock_wait_time.observe(time.perf_counter() - lock_wait_start_time)
+            if game_data.get('hibernated'):
+                # the game has been saved and dropped while we waited for the lock, so it is loaded again
+                continue
+            game_data['last_activity'] = time.monotonic()
+            events = run_game_operation(game_data, operation, data)
+        break
     
-    return {
-        'polygons': polygons,
-        'info': game_state.get_info(),
-        'background': game_state.background_to_render_list[game_state.background_to_render_index],
-        'board_style': game_state.board_to_render_list[game_state.board_to_render_index]
-    }
+    for event_name, payload in events:
+        emit_game_event(event_name, payload, target)
+
+def submit_game_operation(client_id, operation, data=None, target=None):
+    """ Runs game_session.run_game_operation in the geometry worker of the game if they are enabled, otherwise right here """
+    target = target or {'room': client_id}
+    if geometry_workers is not None:
+        geometry_workers.submit(client_id, operation, data, target)
+    else:
+        run_game_operation_locally(client_id, operation, data, target)
+
+def run_game_tick(client_id, actions, mouse_moves, hover_quality):
+    submit_game_operation(client_id, 'tick', {'actions': actions, 'mouse_moves': mouse_moves, 'hover_quality': hover_quality})
+
+# Input of the games is applied by the scheduler, see tick_scheduler.py
+tick_scheduler = TickScheduler(
+    run_game_tick,
+    rate_cap=utils.default_config["tick_rate_cap"],
+    time_budget=utils.default_config["tick_time_budget"],
+    max_actions_per_tick=utils.default_config["max_actions_per_tick"],
+    n_threads=utils.default_config["tick_threads"],
+    governor=HoverQualityGovernor(utils.default_config["tick_time_budget"], utils.default_config["hover_latency_budget"]),
+    remote_tick_timeout=utils.default_config["remote_tick_timeout"],
+)
+
+def count_active_games():
+    if geometry_workers is not None:
+        return len(geometry_workers.get_game_ids())
+    with games_lock:
+        return len(games)
+
+metrics.register_gauge("sugo_active_games", "Games in memory of this process or of the geometry workers", count_active_games)
+metrics.register_gauge("sugo_pending_actions", "Game actions waiting for their ticks", lambda: tick_scheduler.get_pending_counts()[0])
+metrics.register_gauge("sugo_pending_mouse_moves", "Coalesced mouse moves waiting for their ticks", lambda: tick_scheduler.get_pending_counts()[1])
 
 @app.route('/')
 @print_error_if_occured
 def index():
     return render_template('index.html')
 
+@app.route('/shard/<game_id>')
+@print_error_if_occured
+def shard(game_id):
+    """ Where the client of the game connects to, None is this server. launcher.py answers with the process that owns the game """
+    return jsonify({"url": None})
+
+@app.route('/metrics')
+@print_error_if_occured
+def metrics_route():
+    """
+    Hot path timings and load gauges in the Prometheus text format, see metrics.py.
+    The metrics of the geometry workers are their snapshots sent every geometry_workers.HIBERNATION_CHECK_INTERVAL (5 s),
+    so with the workers they lag behind by up to that
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# longest profile of /admin/profile, in seconds
+MAX_PROFILE_SECONDS = 60
+
+def parse_profile_seconds(value):
+    """ ?seconds= of /admin/profile capped by MAX_PROFILE_SECONDS, None if it is not a positive number """
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(seconds) or seconds <= 0:
+        return None
+    return min(seconds, MAX_PROFILE_SECONDS)
+
+def is_admin_token(token):
+    """ Admin endpoints are disabled unless SUGO_ADMIN_TOKEN is set, the token is sent in X-Admin-Token header or ?token= """
+    admin_token = os.environ.get("SUGO_ADMIN_TOKEN")
+    return bool(admin_token) and hmac.compare_digest((token or "").encode(), admin_token.encode())
+
+@app.route('/admin/profile')
+@print_error_if_occured
+def admin_profile():
+    """
+    Samples the live server for ?seconds=N (10 by default), only the work on ?game_id= if it is given,
+    and returns a speedscope profile, see profiler.py. With the geometry workers the games run in the workers and are not sampled
+    """
+    if not is_admin_token(request.headers.get("X-Admin-Token") or request.args.get("token")):
+        return Response("Forbidden", status=403)
+    seconds = parse_profile_seconds(request.args.get("seconds", 10))
+    if seconds is None:
+        return Response("seconds must be a positive number", status=400)
+    report = profiler.profile(seconds, game_id=request.args.get("game_id"))
+    if report is None:
+        return Response("Another profile is running", status=409)
+    return Response(json.dumps(report), mimetype="application/json", headers={"Content-Disposition": "attachment; filename=profile.speedscope.json"})
+
+@app.route('/tick_stats')
+@print_error_if_occured
+def tick_stats():
+    """ Per-game latency and fairness counters of the tick scheduler """
+    return jsonify(tick_scheduler.get_stats())
+
+@app.route('/hover_quality')
+@print_error_if_occured
+def hover_quality():
+    """ Current level of the load-adaptive hover quality """
+    return jsonify(tick_scheduler.get_governor_stats())
+
 @socketio.on('connect')
 @print_error_if_occured
 def handle_connect(*args):
@@ -180,185 +205,120 @@ def handle_connect(*args):
 @print_error_if_occured
 def handle_register(client_id):
     join_room(client_id)
-    with lock:
-        if client_id not in games:
-            config = utils.default_config
-            utils.update_colors(config)
-            games[client_id] = {
-                'history': GameStateHistory(config),
-                'transformation': Transformation(0, 0, shapely.Polygon(config["board_polygon"])),
-                'config': config
-            }
-            # Initialize mouse move buffer for this client
-            mouse_move_buffers[client_id] = []
-        
-        game_data = games[client_id]
-        game_history = game_data['history']
-        transformation = game_data['transformation']
-        config = game_data['config']
-    
-    # Send initial state
-    game_history.update(None)
-    state = game_state_to_dict(game_history.current_game_state, transformation, config)
-    socketio.emit('init', {
-        'type': 'init',
-        'state': state,
-        'config': config
-    }, room=client_id)
+    # the full state is sent to the new member only, the room gets the same updates for all its members
+    submit_game_operation(client_id, 'register', target={'to': request.sid})
 
 
 @socketio.on('join_new_group')
 def join_new_group(data):
     client_id, new_group = data
     leave_room(client_id)
-    if new_group not in games:
-        handle_register(new_group)
-    else:
-        join_room(new_group)
+    submit_game_operation(client_id, 'view', {'sid': request.sid, 'detail_scale': None})
+    handle_register(new_group)
 
 @socketio.on('game_action')
 @print_error_if_occured
 def handle_game_action(data):
     client_id = data.get('client_id')
     
-    if client_id not in games:
+    if not has_game(client_id):
         return
     
-    game_data = games[client_id]
-    game_history = game_data['history']
-    transformation = game_data['transformation']
-    config = game_data['config']
-    
     action_type = data.get('action_type')
+    # the latency up to the update is observed when the tick is done, see game_session.observe_action_latencies
+    data['received_time'] = time.time()
     
-    # Handle special actions
-    if action_type == 'save_game':
-        json_str = game_history.to_json_string()
-        socketio.emit('save_game', {
-            'type': 'save_game',
-            'game_data': json_str
-        }, room=client_id)
-    elif action_type == 'load_game':
-        game_data_str = data['game_data']
-        game_history.load_from_json_string(game_data_str)
-        # Reset transformation
-        transformation.reset()
-        # Update game data
-        game_data['config'] = game_history.config
-        # Send update
-        game_history.update(None)
-        state = game_state_to_dict(game_history.current_game_state, transformation, game_history.config)
-        socketio.emit('update', {
-            'type': 'update',
-            'state': state
-        }, room=client_id)
-    elif action_type == 'mouse_move':
-        # Add to mouse move buffer for batched processing
-        with lock:
-            if all(data.get(elem, None) is not None for elem in ["x", "y", "rel_x", "rel_y"]):
-                mouse_move_buffers[client_id].append(data)
-    else:
-        # Process non-mouse_move actions immediately
-        actions = handle_web_input(data, transformation, game_history)
-        for action in actions:
-            if action["action_type"] == ActionType.MOUSE_SCROLL:
-                transformation.update_self_zoom(action["x"], action["y"], config["zoom_speed"] * action["value"])
-            elif action["action_type"] == ActionType.MOUSE_MOTION and action.get("is_control_pressed"):
-                transformation.update_self_drag(action["rel_x"], action["rel_y"])
-            else:
-                if all(elem not in action or action.get(elem, None) is not None for elem in ["x", "y"]):
-                    game_history.update(action)
-        # Send update
-        game_history.update(None)
-        state = game_state_to_dict(game_history.current_game_state, transformation, config)
-        socketio.emit('update', {
-            'type': 'update',
-            'state': state
-        }, room=client_id)
+    if action_type == 'mouse_move':
+        # mouse moves are coalesced by the scheduler
+        if all(data.get(elem, None) is not None for elem in ["x", "y"]):
+            tick_scheduler.submit_mouse_move(client_id, data)
+        return
+    
+    tick_scheduler.submit_action(client_id, data)
 
+@socketio.on('view')
 @print_error_if_occured
-def process_mouse_moves():
-    """Process batched mouse moves for all clients"""
-    while True:
-        with lock:
-            for client_id, buffer in list(mouse_move_buffers.items()):
-                if not buffer or client_id not in games:
-                    continue
-                
-                game_data = games[client_id]
-                transformation = game_data['transformation']
-                game_history = game_data['history']
-                
-                # Sum relative movements and get last position
-                sum_rel_x = 0
-                sum_rel_y = 0
-                last_x_screen = None
-                last_y_screen = None
-                last_is_control_pressed = None
-
-                for data in buffer:
-                    sum_rel_x += data['rel_x']
-                    sum_rel_y += data['rel_y']
-                    last_x_screen = data['x']
-                    last_y_screen = data['y']
-                    last_is_control_pressed = data['is_control_pressed']
-
-                # Transform to world coordinates
-                last_x, last_y = transformation.screen_to_world(last_x_screen, last_y_screen)
-                sum_rel_x, sum_rel_y = transformation.screen_to_world(sum_rel_x, sum_rel_y)
-                # Create batched action
-                action = {
-                    'action_type': ActionType.MOUSE_MOTION,
-                    'x': last_x,
-                    'y': last_y,
-                    'rel_x': sum_rel_x,
-                    'rel_y': sum_rel_y,
-                    'is_control_pressed': last_is_control_pressed,
-                }
-                
-                # Apply actions
-                if last_is_control_pressed:
-                    transformation.update_self_drag(sum_rel_x, sum_rel_y)
-                else:
-                    game_history.update(action)
-                
-                # Clear buffer
-                buffer.clear()
-                
-                # Send update
-                game_history.update(None)
-                state = game_state_to_dict(game_history.current_game_state, transformation, game_data['config'])
-                socketio.emit('update', {
-                    'type': 'update',
-                    'state': state
-                }, room=client_id)
-
-                # print(f"sending update {client_id = }, stone = {[elem for elem in state['polygons'] if "black" in elem["color"]][0]}")
-        
-        # Wait for next frame
-        socketio.sleep(1/60)
+def handle_view(data):
+    """ Client reports the zoom it needs the geometry for when it changes, see Transformation.level_of_detail """
+    submit_game_operation(data.get('client_id'), 'view', {'sid': request.sid, 'detail_scale': data['detail_scale']})
+
+@socketio.on('request_keyframe')
+@print_error_if_occured
+def handle_request_keyframe(data):
+    """ Client missed a delta, so it gets the full current state """
+    submit_game_operation(data.get('client_id'), 'keyframe', target={'to': request.sid})
 
 @print_error_if_occured
 def save_sessions_periodically():
-    """Periodically save all game sessions"""
+    """Periodically save the games that have changed since their previous save, see game_session.collect_session_changes"""
     while True:
         socketio.sleep(5)  # Save every 5 seconds
-        with lock:
-            for client_id, game_data in games.items():
-                save_game_session(client_id, game_data)
+        save_sessions()
+
+def save_sessions():
+    # the games hibernated by the workers are not reported back, so the scheduler forgets them by their own idle time
+    tick_scheduler.forget_idle_games(utils.default_config["idle_game_timeout"])
+    if geometry_workers is not None:
+        # the workers own the games, so they save them themselves
+        for client_id in geometry_workers.get_game_ids():
+            geometry_workers.submit(client_id, 'save')
+        return
+    
+    with games_lock:
+        games_to_save = list(games.items())
+    
+    for client_id, game_data in games_to_save:
+        # only the changes are collected under the game lock, writing to disk does not block the game
+        with game_data['lock']:
+            changes = collect_session_changes(game_data, utils.default_config["journal_compaction_entries"])
+        if changes is not None and not write_session_changes(client_id, *changes):
+            with game_data['lock']:
+                game_data['needs_snapshot'] = True
+    
+    hibernate_idle_games()
+
+def hibernate_idle_games():
+    """ Saves and drops from memory the idle games and the least recently used games over max_games_in_memory """
+    config = utils.default_config
+    with games_lock:
+        games_to_hibernate = [(client_id, games[client_id]) for client_id in select_games_to_hibernate(games, config["idle_game_timeout"], config["max_games_in_memory"])]
+    
+    for client_id, game_data in games_to_hibernate:
+        # the game is written under its own lock, so it is not loaded back before it is saved
+        with game_data['lock']:
+            if not hibernate_game(client_id, game_data, config["journal_compaction_entries"]):
+                continue
+            with games_lock:
+                if games.get(client_id) is game_data:
+                    del games[client_id]
+        tick_scheduler.forget_game(client_id)
 
 @socketio.on('disconnect')
 @print_error_if_occured
 def handle_disconnect(*args):
     print("Client disconnected")
-    # Could add client cleanup here if needed
+    for room in rooms():
+        # the zoom of the client is dropped only from the games in memory, a hibernated game is not loaded for it
+        if room != request.sid and has_game_in_memory(room):
+            submit_game_operation(room, 'view', {'sid': request.sid, 'detail_scale': None})
+
+def start_geometry_workers():
+    """ SUGO_GEOMETRY_WORKERS=N runs the games in N worker processes sharded by game id, 0 keeps them in this process """
+    global geometry_workers
+    n_geometry_workers = int(os.environ.get("SUGO_GEOMETRY_WORKERS", 0))
+    if n_geometry_workers > 0:
+        geometry_workers = GeometryWorkerPool(n_geometry_workers, emit_game_event, tick_scheduler.report_tick_time, tick_scheduler.forget_game)
+        # the scheduler would only measure the hand-over to the worker, so the ticks are timed by the workers
+        tick_scheduler.remote_ticks = True
+        geometry_workers.start()
 
 if __name__ == '__main__':
     os.makedirs("sessions", exist_ok=True)
+    start_geometry_workers()
     
     # Start background threads
-    socketio.start_background_task(process_mouse_moves)
+    tick_scheduler.start(socketio.start_background_task)
     socketio.start_background_task(save_sessions_periodically)
     
     # Start the server
-    socketio.run(app, host='0.0.0.0', port=5000, debug=False,  allow_unsafe_werkzeug=True)
+    socketio.run(app, host='0.0.0.0', port=int(os.environ.get("SUGO_PORT", 5000)), debug=False,  allow_unsafe_werkzeug=True)
@@ -1,25 +1,35 @@
 from collections import defaultdict
+from functools import lru_cache
 
 import copy
 import math 
 import random
 import shapely
+import time
 
+import metrics
 from utils import argmin, find_uncovered_arcs, thicken_a_line_segment, distance_squared, index_of_stone_that_contains_a_point_or_none
 
 
+@lru_cache(maxsize=16)
+def calculate_board_border_shapes(board, stone_radius):
+    """ Circles and rectangles that cover the board border. They are shared by all the structures on the same board """
+    board_coords = list(board.boundary.coords)
+    board_border_circles = [(*elem, stone_radius * (1 + 1e-5)) for elem in board_coords]
+    board_border_rectangles = []
+    for i in range(len(board_coords) - 1):
+        v1, v2 = board_coords[i], board_coords[i + 1]
+        board_border_rectangles.append(thicken_a_line_segment(*v1, *v2, stone_radius * (1 + 1e-5)))
+    return board_coords, board_border_circles, board_border_rectangles
+
+
 class StoneStructure:
     def __init__(self, stones, stone_radius, board):
         self._n = len(stones)
         self._stones = list(stones)
         self._stone_radius = stone_radius
         self._board = board
-        self._board_coords = list(board.boundary.coords)
-        self._board_border_circles = [(*elem, self._stone_radius * (1 + 1e-5)) for elem in self._board_coords]
-        self._board_border_rectangles = []
-        for i in range(len(self._board_coords) - 1):
-            v1, v2 = self._board_coords[i], self._board_coords[i + 1]
-            self._board_border_rectangles.append(thicken_a_line_segment(*v1, *v2, self._stone_radius * (1 + 1e-5)))
+        self._board_coords, self._board_border_circles, self._board_border_rectangles = calculate_board_border_shapes(board, stone_radius)
         
         self._delone_neighbours = defaultdict(list)
         self._delone_edges_ind = []
@@ -116,6 +126,10 @@ class StoneStructure:
             # print(f"board_board_circles = {self._board_border_circles}")
             # print()
     
+    def get_librety_intervals(self):
+        """ List of (angle of the start, angle of the end) of the librety arcs for every stone """
+        return self._librety_intervals_in_angle_format
+
     def get_small_librety_intervals_in_xy_format(self, threshold_alpha):
         rt = [[] for _ in range(self._n)]
         for i in range(self._n):
@@ -194,9 +208,13 @@ class MyCache:
         for key2, value in self._init_params_dict.items():
             if init_params == value:
                 structure = self.structures_dict[key2]
+                metrics.structure_cache_hits.inc()
                 break
         else:
+            metrics.structure_cache_misses.inc()
+            start_time = time.perf_counter()
             structure = StoneStructure(*init_params.get("args", []), **init_params.get("kwargs", {}), stone_radius=self.stone_radius, board=self.board)
+            metrics.stone_structure_build_time.observe(time.perf_counter() - start_time)
 
         self._init_params_dict[key] = copy.deepcopy(init_params)
         self.structures_dict[key] = structure
@@ -0,0 +1,264 @@
+"""
+Event-driven scheduler of the web games, a game is woken only when it has pending input.
+Actions of a game are queued in order and applied in batches. Mouse moves are coalesced into one pending hover:
+a new one replaces it, so stale hover frames are dropped instead of queued.
+Ticks of a game are rate capped, and a game whose tick overran the time budget waits for the overrun, so it does not starve the others.
+With remote_ticks run_tick only hands the tick over to a geometry worker, the game stays running until the worker reports
+the duration of the tick with report_tick_time (or remote_tick_timeout passes), so a game has at most one tick in flight
+and its mouse moves keep being coalesced while the worker is busy.
+Optional HoverQualityGovernor (see quality_governor.py) observes every tick and sets the quality of hover only ticks,
+remote ticks are observed in two parts: the latency when the tick is handed over and the tick time when it is reported.
+"""
+from collections import defaultdict
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class GameTickStats:
+    """ Latency and fairness counters of a game """
+    def __init__(self):
+        self.ticks = 0
+        self.actions = 0
+        self.mouse_moves_received = 0
+        self.mouse_moves_dropped = 0
+        self.delayed_ticks = 0  # ticks postponed by the rate cap or by the time budget
+        self.latency_total = 0  # from the oldest pending input to the start of its tick
+        self.latency_max = 0
+        self.tick_time_total = 0
+        self.tick_time_max = 0
+        self.timed_out_ticks = 0  # remote ticks whose time was not reported in time
+
+    def add_tick(self, latency, tick_time, n_actions):
+        """ tick_time is None if it is reported later with add_tick_time """
+        self.ticks += 1
+        self.actions += n_actions
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if tick_time is not None:
+            self.add_tick_time(tick_time)
+
+    def add_tick_time(self, tick_time):
+        self.tick_time_total += tick_time
+        self.tick_time_max = max(self.tick_time_max, tick_time)
+
+    def to_json(self):
+        return {
+            "ticks": self.ticks,
+            "actions": self.actions,
+            "mouse_moves_received": self.mouse_moves_received,
+            "mouse_moves_dropped": self.mouse_moves_dropped,
+            "delayed_ticks": self.delayed_ticks,
+            "latency_mean": self.latency_total / self.ticks if self.ticks else 0,
+            "latency_max": self.latency_max,
+            "tick_time_total": self.tick_time_total,
+            "tick_time_mean": self.tick_time_total / self.ticks if self.ticks else 0,
+            "tick_time_max": self.tick_time_max,
+            "timed_out_ticks": self.timed_out_ticks,
+        }
+
+
+class PendingInput:
+    def __init__(self):
+        self.actions = []
+        self.mouse_move = None
+        self.oldest_input_time = None
+
+    def is_empty(self):
+        return not self.actions and self.mouse_move is None
+
+
+class TickScheduler:
+    def __init__(self, run_tick, rate_cap=60, time_budget=0.01, max_actions_per_tick=16, n_threads=4, governor=None, remote_tick_timeout=5):
+        """
+        run_tick(game_id, actions, mouse_moves, hover_quality) applies the input of a game and sends the update,
+        actions is a list of game_action payloads, mouse_moves is a list with at most one coalesced mouse_move payload,
+        hover_quality is game_state.HoverQuality to use if there are no actions.
+        remote_tick_timeout is how many seconds a remote tick may stay unreported before the game ticks again, e.g. after its worker died
+        """
+        self._run_tick = run_tick
+        # run_tick only queues the tick in another process, which reports its duration with report_tick_time
+        self.remote_ticks = False
+        self.remote_tick_timeout = remote_tick_timeout
+        self._remote_ticks_in_flight = dict()  # game id -> (start time, has actions) of its tick that has not been reported yet
+        self.governor = governor
+        self.rate_cap = rate_cap
+        self.time_budget = time_budget
+        self.max_actions_per_tick = max_actions_per_tick
+        self.n_threads = n_threads
+        self._condition = threading.Condition()
+        self._pending = dict()  # game id -> PendingInput
+        self._ready = []  # heap of (time to run, sequence number, game id)
+        self._sequence = itertools.count()
+        self._scheduled = set()
+        self._running = set()
+        self._next_tick_time = dict()  # game id -> the earliest time of its next tick
+        self.stats = defaultdict(GameTickStats)
+
+    def start(self, start_thread):
+        """ start_thread(target) starts a background thread, e.g. socketio.start_background_task """
+        for _ in range(self.n_threads):
+            start_thread(self._run)
+
+    def submit_action(self, game_id, action):
+        with self._condition:
+            pending = self._get_pending(game_id)
+            pending.actions.append(action)
+            self._schedule(game_id)
+
+    def submit_mouse_move(self, game_id, mouse_move):
+        with self._condition:
+            self.stats[game_id].mouse_moves_received += 1
+            pending = self._get_pending(game_id)
+            if pending.mouse_move is not None:
+                self.stats[game_id].mouse_moves_dropped += 1
+            pending.mouse_move = mouse_move
+            self._schedule(game_id)
+
+    def get_stats(self):
+        with self._condition:
+            return {game_id: stats.to_json() for game_id, stats in self.stats.items()}
+
+    def get_pending_counts(self):
+        """ Queued actions and coalesced mouse moves waiting for their ticks """
+        with self._condition:
+            n_actions = sum(len(pending.actions) for pending in self._pending.values())
+            n_mouse_moves = sum(pending.mouse_move is not None for pending in self._pending.values())
+            return n_actions, n_mouse_moves
+
+    def report_tick_time(self, game_id, tick_time):
+        """
+        Duration of a tick that has run in a geometry worker, see remote_ticks. The report of a tick that has timed out
+        is taken for the next tick of the game, which may then overlap with the one after it
+        """
+        with self._condition:
+            if game_id in self.stats:
+                self.stats[game_id].add_tick_time(tick_time)
+            if self.governor is not None:
+                self.governor.observe_tick_time(tick_time)
+            in_flight = self._remote_ticks_in_flight.pop(game_id, None)
+            if in_flight is not None:
+                start_time, has_actions = in_flight
+                self._finish_tick(game_id, start_time, tick_time, has_actions)
+
+    def forget_idle_games(self, idle_timeout):
+        """ Drops the stats and the tick times of the games without pending input for longer than idle_timeout seconds """
+        with self._condition:
+            now = time.monotonic()
+            idle_game_ids = [game_id for game_id, tick_time in self._next_tick_time.items() if game_id not in self._pending and now - tick_time > idle_timeout]
+            for game_id in idle_game_ids:
+                self._forget_game(game_id)
+
+    def forget_game(self, game_id):
+        """ Drops the stats and the tick time of a hibernated game, unless it already has new input """
+        with self._condition:
+            if game_id not in self._pending:
+                self._forget_game(game_id)
+
+    def _forget_game(self, game_id):
+        """ Must be called under self._condition """
+        self._next_tick_time.pop(game_id, None)
+        self.stats.pop(game_id, None)
+
+    def get_governor_stats(self):
+        with self._condition:
+            return self.governor.to_json() if self.governor is not None else None
+
+    def _get_pending(self, game_id):
+        pending = self._pending.get(game_id)
+        if pending is None:
+            pending = self._pending[game_id] = PendingInput()
+        if pending.oldest_input_time is None:
+            pending.oldest_input_time = time.monotonic()
+        return pending
+
+    def _schedule(self, game_id):
+        """ Must be called under self._condition """
+        if game_id in self._scheduled or game_id in self._running:
+            return
+        now = time.monotonic()
+        tick_time = self._next_tick_time.get(game_id, now)
+        if tick_time > now:
+            self.stats[game_id].delayed_ticks += 1
+        heapq.heappush(self._ready, (max(tick_time, now), next(self._sequence), game_id))
+        self._scheduled.add(game_id)
+        self._condition.notify()
+
+    def _expire_remote_ticks(self, now):
+        """ Finishes the remote ticks unreported for remote_tick_timeout. Returns the time of the next expiry or None. Must be called under self._condition """
+        next_expiry_time = None
+        for game_id, (start_time, has_actions) in list(self._remote_ticks_in_flight.items()):
+            expiry_time = start_time + self.remote_tick_timeout
+            if expiry_time <= now:
+                del self._remote_ticks_in_flight[game_id]
+                self.stats[game_id].timed_out_ticks += 1
+                self._finish_tick(game_id, start_time, 0, has_actions)
+            elif next_expiry_time is None or expiry_time < next_expiry_time:
+                next_expiry_time = expiry_time
+        return next_expiry_time
+
+    def _take_next_game(self):
+        """ Waits for the next game to tick, returns its id and its input. Must be called under self._condition """
+        while True:
+            now = time.monotonic()
+            next_expiry_time = self._expire_remote_ticks(now)
+            if self._ready and self._ready[0][0] <= now:
+                break
+            wake_times = [wake_time for wake_time in [self._ready[0][0] if self._ready else None, next_expiry_time] if wake_time is not None]
+            self._condition.wait(min(wake_times) - now if wake_times else None)
+
+        _, _, game_id = heapq.heappop(self._ready)
+        self._scheduled.discard(game_id)
+        self._running.add(game_id)
+        pending = self._pending[game_id]
+        actions = pending.actions[:self.max_actions_per_tick]
+        pending.actions = pending.actions[self.max_actions_per_tick:]
+        mouse_moves = []
+        if not pending.actions and pending.mouse_move is not None:
+            mouse_moves.append(pending.mouse_move)
+            pending.mouse_move = None
+        latency = now - pending.oldest_input_time
+        pending.oldest_input_time = None if pending.is_empty() else now
+        return game_id, actions, mouse_moves, latency
+
+    def _run(self):
+        while True:
+            with self._condition:
+                game_id, actions, mouse_moves, latency = self._take_next_game()
+                hover_quality = self.governor.level if self.governor is not None else 0
+
+            start_time = time.monotonic()
+            try:
+                self._run_tick(game_id, actions, mouse_moves, hover_quality)
+            except Exception:
+                traceback.print_exc()
+            # a remote tick is only queued here, the game keeps running until report_tick_time
+            tick_time = None if self.remote_ticks else time.monotonic() - start_time
+
+            with self._condition:
+                self.stats[game_id].add_tick(latency, tick_time, len(actions))
+                if self.governor is not None:
+                    if tick_time is None:
+                        self.governor.observe_latency(latency)
+                    else:
+                        self.governor.observe(tick_time, latency)
+                if tick_time is None:
+                    self._remote_ticks_in_flight[game_id] = (start_time, bool(actions))
+                    # the expiry of the tick is a new wake up time for a waiting thread
+                    self._condition.notify()
+                else:
+                    self._finish_tick(game_id, start_time, tick_time, bool(actions))
+
+    def _finish_tick(self, game_id, start_time, tick_time, has_actions):
+        """ The game can tick again after the rate cap and the overrun of the time budget. Must be called under self._condition """
+        self._running.discard(game_id)
+        tick_interval = 1 / self.rate_cap
+        if self.governor is not None and not has_actions:
+            tick_interval *= self.governor.hover_rate_divisor()
+        self._next_tick_time[game_id] = start_time + tick_interval + max(0, tick_time - self.time_budget)
+        if self._pending[game_id].is_empty():
+            del self._pending[game_id]
+        else:
+            self._schedule(game_id)
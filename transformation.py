@@ -19,10 +19,15 @@ class Transformation:
     
     def to_json(self):
         return {"offset_x": self._offset_x, "offset_y": self._offset_y, "log_scale": self._log_scale}
-    
+
     @staticmethod
     def from_json(json, config):
-        return Transformation(json["offset_x"], json["offset_y"], json["log_scale"], config["board_polygon"])
+        """ Restored transformation is reset to the default one, not to the restored """
+        transformation = Transformation(0, 0, shapely.Polygon(config["board_polygon"]))
+        transformation._offset_x = json["offset_x"]
+        transformation._offset_y = json["offset_y"]
+        transformation._log_scale = json["log_scale"]
+        return transformation
 
     def reset(self):
         self.__init__(**self._init_pararms)
@@ -35,6 +40,30 @@ class Transformation:
         y = int(wy * self.scale() + self._offset_y)
         return x, y
 
+    def level_of_detail(self, stone_radius, viewport_size=None, pixel_tolerance=0.5, scale=None):
+        """
+        Returns how detailed the geometry should be at the current zoom (or at the given scale):
+            quad_segs: number of segments in a quarter of tessellated circles, so that stone borders (radius 2 * stone_radius) deviate less than pixel_tolerance
+            simplify_tolerance: tolerance of polygons simplification in world units
+            min_highlight_size: small librety highlighters that are shorter than it (in world units) are not drawn
+            viewport: (min_x, min_y, max_x, max_y) visible part of the world if viewport_size (in pixels) is given, None otherwise
+        """
+        scale = scale or self.scale()
+        border_radius = 2 * stone_radius * scale
+        quad_segs = 2
+        if border_radius > pixel_tolerance:
+            quad_segs = math.ceil(math.pi / 4 / math.acos(1 - pixel_tolerance / border_radius))
+        
+        viewport = None
+        if viewport_size is not None:
+            viewport = (*self.screen_to_world(0, 0), *self.screen_to_world(*viewport_size))
+        return {
+            "quad_segs": min(max(quad_segs, 2), 16),
+            "simplify_tolerance": pixel_tolerance / scale,
+            "min_highlight_size": 1 / scale,
+            "viewport": viewport,
+        }
+
     def world_to_screen_distance(self, wd):
         return wd * self.scale()
 
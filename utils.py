@@ -1,6 +1,8 @@
+import hashlib
+import inspect
 import math
 from datetime import datetime
-from functools import lru_cache
+from functools import lru_cache, wraps
 
 import numpy as np
 import pygame
@@ -25,15 +27,20 @@ board_size = r = 640
 
 world_size = 980
 
+# board shapes, 'board_polygon' of the config is one of them
+board_polygons = {
+    'square': [[0, 0], [board_size, 0], [board_size, board_size], [0, board_size]],
+    'l_shape': [[100, 0], [board_size, 0], [board_size, board_size], [0, board_size], [0, 100], [100, 100]],
+    'hexagon': [[0, r / 2], [r/4, r * (1 - math.sqrt(3) / 2) / 2], [3 * r/4, r * (1 - math.sqrt(3) / 2) / 2], [r, r / 2], [3 * r / 4 , r * (1 + math.sqrt(3) / 2) / 2], [r / 4 , r * (1 + math.sqrt(3) / 2) / 2]],
+}
+
 default_config = {
     'width': world_size,
     'height': world_size,
     'fps': 30,
     'board_width': board_size,
     'board_height': board_size,
-    'board_polygon':  [[0, 0], [board_size, 0], [board_size, board_size], [0, board_size]], 
-    # 'board_polygon':  [[100, 0], [board_size, 0], [board_size, board_size], [0, board_size], [0, 100], [100, 100]],
-    # 'board_polygon':  [[0, r / 2], [r/4, r * (1 - math.sqrt(3) / 2) / 2], [3 * r/4, r * (1 - math.sqrt(3) / 2) / 2], [r, r / 2], [3 * r / 4 , r * (1 + math.sqrt(3) / 2) / 2], [r / 4 , r * (1 + math.sqrt(3) / 2) / 2]], 
+    'board_polygon': board_polygons['square'],
     'board_color': (204, 102, 0),
     'cloud_scale': 0.25,
     'stone_radius': board_size / 13 / 2,
@@ -72,6 +79,20 @@ default_config = {
     'minimal_librety_angle_to_hightlight': math.pi / 180 * 20,
     "komi": 6.5,
     "bottom_panel_width": 180,
+    "position_hash_quantum": 1e-3,
+    "keyframe_interval": 100,
+    "tick_rate_cap": 60,
+    "tick_time_budget": 0.01,
+    "max_actions_per_tick": 16,
+    "tick_threads": 4,
+    "remote_tick_timeout": 5,
+    "hover_latency_budget": 0.05,
+    "journal_compaction_entries": 100,
+    "idle_game_timeout": 600,
+    "max_games_in_memory": 1000,
+    "hover_preview_interval": 0.1,
+    "show_frame_timings": False,
+    "frame_timings_window": 60,
 }
 
 def update_colors(config):
@@ -90,6 +111,27 @@ def update_colors(config):
             colors[key_minus_suffix] = tuple(alpha * elem1 + (1 -  alpha) * elem2 for elem1, elem2 in zip(config[key], config["board_color"]))
 
 
+def print_error_if_occured(func):
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_rt(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+        return async_rt
+
+    @wraps(func)
+    def rt(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+    return rt
+
+
 def calculate_deltax_deltay(config):
     return (config['width'] - config['board_width']) / 2, (config['height'] - config['board_height'] - config["bottom_panel_width"]) / 2
 
@@ -155,6 +197,23 @@ def group_has_librety(group, stones_structure):
     return any(stones_structure.stone_has_librety(i) for i in group)
 
 
+def stone_fingerprint(x, y, color, quantum):
+    """ 64-bit hash of a stone, coordinates are rounded to the multiples of `quantum` """
+    key = f"{round(x / quantum)}:{round(y / quantum)}:{color}".encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def calculate_position_hash(stones, quantum):
+    """
+    Order-independent hash of a position (xor of stone fingerprints).
+    Adding or removing a stone updates it in O(1): position_hash ^= stone_fingerprint(...)
+    """
+    rt = 0
+    for stone in stones:
+        rt ^= stone_fingerprint(stone.x, stone.y, stone.color, quantum)
+    return rt
+
+
 def rotation_matrix(angle):
     return np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
 
@@ -0,0 +1,246 @@
+import math
+
+import numpy as np
+import shapely
+
+from game_state import GLYPH_KINDS
+from utils import distance_squared, project_point_onto_polygon
+
+
+def pack_ids(ids):
+    return np.array(ids, dtype='<u4').tobytes()
+
+
+def pack_shapes(shapes):
+    """
+    Packs list of shapes produced by game_state_to_dict (each with an 'id' added) into binary buffers
+    that are sent as Socket.IO binary attachments. Shapes are grouped by kind:
+        polygons: ids (uint32), offsets (uint32 per shape + 1, shape i has vertices offsets[i]...offsets[i + 1] - 1),
+                  coords (float32 x, y pairs of all the vertices), colors
+        circles: ids, params (float32 x, y, r, width per circle), colors
+        glyphs: ids, glyphs (uint8 index into GLYPH_KINDS), params (float32 x, y, size per glyph), colors
+    colors are uint8 indexes into palette, the list of color names.
+    Coordinates and sizes are in world units. All numbers are little-endian.
+    """
+    palette = list(dict.fromkeys(shape['color'] for shape in shapes))
+    color_to_index = {color: i for i, color in enumerate(palette)}
+    shapes_by_kind = {kind: [shape for shape in shapes if shape['kind'] == kind] for kind in ['polygon', 'circle', 'glyph']}
+
+    def pack_ids_and_colors(shapes_of_kind):
+        return {
+            'ids': pack_ids([shape['id'] for shape in shapes_of_kind]),
+            'colors': np.array([color_to_index[shape['color']] for shape in shapes_of_kind], dtype=np.uint8).tobytes(),
+        }
+
+    polygons = shapes_by_kind['polygon']
+    vertices_counts = [len(shape['points']) for shape in polygons]
+    coords = np.concatenate([shape['points'] for shape in polygons]) if polygons else np.zeros((0, 2))
+    circles = shapes_by_kind['circle']
+    glyphs = shapes_by_kind['glyph']
+    return {
+        'polygons': pack_ids_and_colors(polygons) | {
+            'offsets': np.concatenate([[0], np.cumsum(vertices_counts)]).astype('<u4').tobytes(),
+            'coords': coords.astype('<f4').tobytes(),
+        },
+        'circles': pack_ids_and_colors(circles) | {
+            'params': np.array([[shape['x'], shape['y'], shape['r'], shape['width']] for shape in circles], dtype='<f4').tobytes(),
+        },
+        'glyphs': pack_ids_and_colors(glyphs) | {
+            'glyphs': np.array([GLYPH_KINDS.index(shape['glyph']) for shape in glyphs], dtype=np.uint8).tobytes(),
+            'params': np.array([[shape['x'], shape['y'], shape['size']] for shape in glyphs], dtype='<f4').tobytes(),
+        },
+        'palette': palette,
+    }
+
+
+def packed_size(payload):
+    """ Total size of the binary buffers of a payload """
+    if isinstance(payload, bytes):
+        return len(payload)
+    if isinstance(payload, dict):
+        return sum(packed_size(value) for value in payload.values())
+    return 0
+
+
+def pack_snapping(snapping):
+    """
+    Packs GameState.get_snapping_data() for the web client, that snaps the suggestion stone itself:
+        stones: float64 x, y pairs, colors: list of stone colors,
+        intervals: float64 (start, end) angle pairs of the librety arcs of all the stones, NaN for an open end,
+                   stone i has intervals interval_offsets[i]...interval_offsets[i + 1] - 1 (uint32),
+        board_inner: float64 x, y pairs of the board part where stones can be placed
+    the rest of the fields are sent as is. All numbers are little-endian.
+    """
+    intervals = [interval for stone_intervals in snapping['librety_intervals'] for interval in stone_intervals]
+    intervals_counts = [len(stone_intervals) for stone_intervals in snapping['librety_intervals']]
+    return {
+        'stones': np.array(snapping['stones'], dtype='<f8').reshape(-1, 2).tobytes(),
+        'colors': snapping['colors'],
+        'intervals': np.array([[math.nan if angle is None else angle for angle in interval] for interval in intervals], dtype='<f8').reshape(-1, 2).tobytes(),
+        'interval_offsets': np.concatenate([[0], np.cumsum(intervals_counts)]).astype('<u4').tobytes(),
+        'board_inner': np.array(snapping['board_inner'], dtype='<f8').tobytes(),
+    } | {key: snapping[key] for key in ['stone_radius', 'snap_color', 'is_hidden', 'is_fake_stone_mode', 'suggestion_color']}
+
+
+def unpack_snapping(packed):
+    """ Inverse of pack_snapping, for the Python clients (see loadtest.py) """
+    stones = np.frombuffer(packed['stones'], dtype='<f8').reshape(-1, 2)
+    intervals = np.frombuffer(packed['intervals'], dtype='<f8').reshape(-1, 2)
+    offsets = np.frombuffer(packed['interval_offsets'], dtype='<u4')
+    return {
+        'stones': [tuple(stone) for stone in stones.tolist()],
+        'colors': packed['colors'],
+        'librety_intervals': [
+            [tuple(None if math.isnan(angle) else angle for angle in interval) for interval in intervals[offsets[i]:offsets[i + 1]].tolist()]
+            for i in range(len(packed['colors']))
+        ],
+        'board_inner': [tuple(point) for point in np.frombuffer(packed['board_inner'], dtype='<f8').reshape(-1, 2).tolist()],
+    } | {key: packed[key] for key in ['stone_radius', 'snap_color', 'is_hidden', 'is_fake_stone_mode', 'suggestion_color']}
+
+
+def has_liberty_in_direction(intervals, angle):
+    """ Same as StoneStructure.has_liberty_in_direction """
+    angle = angle % (2 * math.pi)
+    if angle > math.pi:
+        angle -= 2 * math.pi
+    return any((start is None or start <= angle) and (end is None or angle <= end) for start, end in intervals)
+
+
+def snap_point(snapping, x, y):
+    """
+    Reference implementation of the snapping done by the web client, for the load tests,
+    benchmarks/snap_point_check.py checks it against GameState._snap_stone.
+    Takes GameState.get_snapping_data() and the pointer in world coordinates,
+    returns where the suggestion stone is shown or None if it is hidden,
+    the same as GameState.update_suggestion_stone_status and GameState._snap_stone do.
+    """
+    if snapping['is_hidden']:
+        return None
+    x, y = project_point_onto_polygon(shapely.Polygon(snapping['board_inner']), shapely.Point(x, y)).coords[0]
+    stone_radius = snapping['stone_radius']
+    stones = snapping['stones']
+    if any(distance_squared(stone_x - x, stone_y - y) <= (stone_radius / 5) ** 2 for stone_x, stone_y in stones):
+        return None
+    if snapping['is_fake_stone_mode'] and any(
+        "_hollow" in color and distance_squared(stone_x - x, stone_y - y) <= stone_radius ** 2
+        for (stone_x, stone_y), color in zip(stones, snapping['colors'])
+    ):
+        return None
+
+    snap_color = snapping['snap_color']
+    if snap_color is None and not any(distance_squared(stone_x - x, stone_y - y) <= (2 * stone_radius) ** 2 for stone_x, stone_y in stones):
+        return x, y
+    
+    candidate_points = []
+    for (stone_x, stone_y), color, intervals in zip(stones, snapping['colors'], snapping['librety_intervals']):
+        if snap_color is not None and color != snap_color:
+            continue
+        if has_liberty_in_direction(intervals, math.atan2(y - stone_y, x - stone_x)):
+            dist = math.sqrt(distance_squared(x - stone_x, y - stone_y))
+            candidate_points.append((stone_x + (x - stone_x) / dist * 2 * stone_radius, stone_y + (y - stone_y) / dist * 2 * stone_radius))
+        for angle_start, angle_end in intervals:
+            candidate_points.append((stone_x + 2 * stone_radius * math.cos(angle_start), stone_y + 2 * stone_radius * math.sin(angle_start)))
+            candidate_points.append((stone_x + 2 * stone_radius * math.cos(angle_end), stone_y + 2 * stone_radius * math.sin(angle_end)))
+    
+    if not candidate_points:
+        return None
+    return min(candidate_points, key=lambda point: distance_squared(point[0] - x, point[1] - y))
+
+
+class StateDiffer:
+    """
+    Versioned diff protocol for the web client.
+    Remembers shapes of the last state sent to a room and turns every new state into a delta:
+    shapes that were added (with their points), ids of the removed shapes and the new drawing order (only if it changed).
+    Every keyframe_interval updates (and on client request) a keyframe with all the shapes is sent instead,
+    keyframe of a version is built once and reused for every client that asks for it.
+    Delta of version v is based on version v - 1, so a client that missed an update asks for a keyframe.
+    Shapes are sent in the packed binary format, see pack_shapes.
+    SPARSE_FIELDS of the state are sent in a delta only if they have changed, the client keeps the last ones.
+    """
+    SPARSE_FIELDS = ('snapping',)
+
+    def __init__(self, keyframe_interval=100):
+        self.keyframe_interval = keyframe_interval
+        self.version = 0
+        self._updates_since_keyframe = 0
+        self._next_shape_id = 0
+        self._shape_key_to_id = dict()
+        self._shapes = dict()  # shape id -> shape of game_state_to_dict with 'id' added
+        self._order = []  # shape ids in drawing order
+        self._state_without_shapes = dict()
+        self._keyframe = None  # keyframe of the current version
+
+    @staticmethod
+    def _shape_key(shape):
+        if shape['kind'] == 'polygon':
+            return ('polygon', shape['color'], shape['points'].tobytes())
+        if shape['kind'] == 'circle':
+            return ('circle', shape['color'], shape['x'], shape['y'], shape['r'], shape['width'])
+        return ('glyph', shape['glyph'], shape['color'], shape['x'], shape['y'], shape['size'])
+
+    def _shape_id(self, shape, new_shape_keys_to_ids):
+        key = self._shape_key(shape)
+        shape_id = self._shape_key_to_id.get(key)
+        if shape_id is None:
+            shape_id = new_shape_keys_to_ids.get(key)
+        if shape_id is None:
+            shape_id = self._next_shape_id
+            self._next_shape_id += 1
+        new_shape_keys_to_ids[key] = shape_id
+        return shape_id
+
+    def make_update(self, state):
+        """ Takes game_state_to_dict output, returns keyframe or delta payload for the 'state' field of 'update' event """
+        new_shape_keys_to_ids = dict()
+        order = []
+        added = []
+        new_shapes = dict()
+        for shape in state['shapes']:
+            shape_id = self._shape_id(shape, new_shape_keys_to_ids)
+            order.append(shape_id)
+            if shape_id in new_shapes:
+                continue
+            new_shapes[shape_id] = self._shapes.get(shape_id) or {'id': shape_id} | shape
+            if shape_id not in self._shapes:
+                added.append(new_shapes[shape_id])
+
+        removed = [shape_id for shape_id in self._shapes if shape_id not in new_shapes]
+        order_changed = order != self._order
+        state_without_shapes = {key: value for key, value in state.items() if key != 'shapes'}
+        changed_fields = {
+            key: value for key, value in state_without_shapes.items()
+            if key not in self.SPARSE_FIELDS or self._state_without_shapes.get(key) != value
+        }
+
+        self._shape_key_to_id = new_shape_keys_to_ids
+        self._shapes = new_shapes
+        self._order = order
+        self._state_without_shapes = state_without_shapes
+        self.version += 1
+        self._keyframe = None
+
+        self._updates_since_keyframe += 1
+        if self._updates_since_keyframe >= self.keyframe_interval:
+            return self.make_keyframe()
+
+        return {
+            'type': 'delta',
+            'version': self.version,
+            'base_version': self.version - 1,
+            'added': pack_shapes(added),
+            'removed': pack_ids(removed),
+            'order': pack_ids(order) if order_changed else None,
+        } | changed_fields
+
+    def make_keyframe(self):
+        """ Full state of the current version """
+        self._updates_since_keyframe = 0
+        if self._keyframe is None:
+            self._keyframe = {
+                'type': 'keyframe',
+                'version': self.version,
+                'shapes': pack_shapes(list(self._shapes.values())),
+                'order': pack_ids(self._order),
+            } | self._state_without_shapes
+        return self._keyframe